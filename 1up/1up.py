@@ -1,143 +1,2603 @@
-import ndjson
 import glob
 import argparse
+import bisect
+import csv
+import hashlib
+import json
+import mmap
+import os
+import queue
+import sqlite3
 import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from resource import RUSAGE_SELF, getrusage
+except ImportError:
+    getrusage = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DATA_DIR = './data'
+INDEX_PATH = os.path.join(DATA_DIR, '1up.index.sqlite')
+INDEX_FILES_PATH = os.path.join(DATA_DIR, '1up.index.files.json')
+INDEX_VERSION = 7
+EDGES_PATH = os.path.join(DATA_DIR, '1up.edges.npz')
+ENCOUNTERS_PATH = os.path.join(DATA_DIR, '1up.encounters.sqlite')
+MATRIX_PATH = os.path.join(DATA_DIR, '1up.matrix.npz')
+GRAPH_PATH = os.path.join(DATA_DIR, '1up.graph.npz')
+
+# The lookup tables an encounter's references are joined against
+ENTITY_FILES = ['Practitioner.ndjson', 'Location.ndjson', 'Organization.ndjson']
+
+# Types the reference graph doesn't walk through: shared by many patients, they'd link them all
+HUB_TYPES = ['Patient', 'Practitioner', 'PractitionerRole', 'Organization', 'Location', 'Medication']
+
+# Files larger than this are split into byte ranges for the worker processes
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Resource files can be plain or compressed ndjson
+NDJSON_EXTENSIONS = ['.ndjson', '.ndjson.gz', '.ndjson.zst']
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Compressed files are decompressed this many bytes at a time, up to DECOMPRESS_AHEAD chunks ahead
+DECOMPRESS_CHUNK = 1024 * 1024
+DECOMPRESS_AHEAD = 8
+
+# How many bytes before the indexed offset are checksummed to tell appends from rewrites
+CHECKSUM_WINDOW = 64 * 1024
+
+# The fields reference counting reads from each resourceType, '*' meaning every type
+REFERENCE_FIELDS = {'*': ['resourceType', 'id', 'patient.reference', 'subject.reference'],
+                    'Patient': ['name'],
+                    'Encounter': ['participant[].individual.reference', 'location[].location.reference',
+                                  'serviceProvider.reference']}
+
+
+def materialize(value):
+    """Returns a simdjson object or array as a dict or list, and anything else as it is"""
+    if hasattr(value, 'as_dict'):
+        return value.as_dict()
+    if hasattr(value, 'as_list'):
+        return value.as_list()
+    return value
+
+
+def select_field(value, path, selected):
+    """Copies the field at path from a decoded object into the dict selected, keeping its nesting
+
+    path is a list of keys, where 'key[]' walks every item of a list.
+    """
+    key = path[0]
+    each = key.endswith('[]')
+    if each:
+        key = key[:-2]
+    if key not in value:
+        return
+    child = value[key]
+    if len(path) == 1:
+        selected[key] = materialize(child)
+    elif each:
+        items = selected.setdefault(key, [{} for _ in child])
+        for item, selected_item in zip(child, items):
+            select_field(item, path[1:], selected_item)
+    else:
+        select_field(child, path[1:], selected.setdefault(key, {}))
+
+
+class Decoder:
+    """Decodes ndjson lines with orjson or simdjson when installed, otherwise the json module
+
+    fields is {resourceType: [field paths]}, '*' applying to every type, to decode only
+    the fields a caller reads; a path is dotted keys, 'key[]' walking a list. Only
+    simdjson parses lazily, so only it skips the other fields. orjson and json build
+    the whole resource in C either way, and picking fields out afterwards would just
+    add time, so they return whole resources.
+    """
+    def __init__(self, fields=None, backend='auto'):
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else 'simdjson' if simdjson is not None else 'json'
+        if {'orjson': orjson, 'simdjson': simdjson}.get(backend, json) is None:
+            package = 'pysimdjson' if backend == 'simdjson' else backend
+            raise ImportError(f'The {backend} decoder is not installed: pip install {package}')
+        self.backend = backend
+        self.fields = None
+        if fields is not None:
+            self.fields = {resource_type: [path.split('.') for path in paths]
+                           for resource_type, paths in fields.items()}
+
+        if backend == 'orjson':
+            self.decode = orjson.loads
+        elif backend == 'simdjson':
+            self.parser = simdjson.Parser()
+            self.decode = self.decode_fields if self.fields is not None else self.decode_whole
+        else:
+            self.decode = json.loads
+
+
+    def decode_whole(self, line):
+        return self.parser.parse(line, True)
+
+
+    def decode_fields(self, line):
+        document = self.parser.parse(line)
+        resource = {}
+        for path in self.fields.get('*', []) + self.fields.get(document.get('resourceType'), []):
+            select_field(document, path, resource)
+        return resource
+
+
+# Whole resources, and the fields reference counting needs; use_decoder swaps the backend
+DECODER = Decoder()
+REFERENCE_DECODER = Decoder(REFERENCE_FIELDS)
+
+
+def use_decoder(backend):
+    """Switches every ndjson read to a decoder backend: auto, orjson, simdjson or json"""
+    global DECODER, REFERENCE_DECODER
+    DECODER = Decoder(backend=backend)
+    REFERENCE_DECODER = Decoder(REFERENCE_FIELDS, backend)
+
+
+
+def compression(path):
+    """Returns 'gzip' or 'zstd' for a compressed ndjson file, or None for a plain one"""
+    return COMPRESSIONS.get(os.path.splitext(path)[1])
+
+
+def resource_name(path):
+    """Returns the file name of a resource file without its compression extension, e.g. 'Patient.ndjson'"""
+    name = os.path.basename(path)
+    if compression(name) is not None:
+        name = os.path.splitext(name)[0]
+    return name
+
+
+def resource_files(data_dir=DATA_DIR):
+    """Returns the sorted paths of every resource file, plain or compressed"""
+    return sorted(path for extension in NDJSON_EXTENSIONS
+                  for path in glob.glob(os.path.join(data_dir, '*' + extension)))
+
+
+def resource_file(name, data_dir=DATA_DIR):
+    """Returns the path of a resource file such as 'Patient.ndjson', which may be compressed
+
+    The plain path is returned when there's no such file, so callers can still check it exists.
+    """
+    for extension in ['', '.gz', '.zst']:
+        path = os.path.join(data_dir, name + extension)
+        if os.path.exists(path):
+            return path
+    return os.path.join(data_dir, name)
+
+
+def iter_decompressed(path):
+    """Yields the decompressed bytes of a gzip or zstd file, every member or frame, in chunks"""
+    if compression(path) == 'zstd':
+        if zstandard is None:
+            raise ImportError('Reading .zst files needs zstandard: pip install zstandard')
+        with zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True,
+                                                         closefd=True) as inf:
+            yield from iter(lambda: inf.read(DECOMPRESS_CHUNK), b'')
+        return
+
+    # zlib directly rather than gzip.open, which does part of its work in Python
+    with open(path, 'rb') as inf:
+        decompressor = zlib.decompressobj(wbits=31)
+        for data in iter(lambda: inf.read(DECOMPRESS_CHUNK), b''):
+            while data:
+                yield decompressor.decompress(data)
+                data = b''
+                if decompressor.eof:
+                    # The next gzip member starts in what's left over
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+
+
+def decompress(path, data):
+    """Decompresses one whole gzip member or zstd frame"""
+    if compression(path) == 'gzip':
+        return zlib.decompress(data, wbits=31)
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def iter_decompressed_lines(path):
+    """Yields the lines of a compressed file, decompressing in a background thread
+
+    zlib and zstandard release the GIL while they work, so the chunks ahead are
+    decompressed while the current lines are decoded. The thread stops when the
+    caller does, even if it stops early.
+    """
+    chunks = queue.Queue(maxsize=DECOMPRESS_AHEAD)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read_chunks():
+        try:
+            for chunk in iter_decompressed(path):
+                put(chunk)
+            put(None)
+        except Exception as error:
+            put(error)
+
+    thread = threading.Thread(target=read_chunks, daemon=True)
+    thread.start()
+    try:
+        buffer = b''
+        for chunk in iter(chunks.get, None):
+            if isinstance(chunk, Exception):
+                raise chunk
+            lines = chunk.split(b'\n')
+            lines[0] = buffer + lines[0]
+            buffer = lines.pop()
+            yield from lines
+        if buffer:
+            yield buffer
+    finally:
+        stop.set()
+        thread.join()
+
+
+def gzip_members(inf, size):
+    """Returns the offsets of the members of a BGZF file, or None for any other gzip file
+
+    BGZF (from bgzip) records each member's compressed size in a 'BC' extra
+    subfield, so the members can be found without decompressing anything.
+    """
+    offsets = []
+    offset = 0
+    while offset < size:
+        inf.seek(offset)
+        header = inf.read(18)
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:16] != b'BC\x02\x00':
+            return None
+        offsets.append(offset)
+        offset += int.from_bytes(header[16:18], 'little') + 1
+    return offsets
+
+
+def zstd_frames(inf, size):
+    """Returns the offsets of the frames of a zstd file, walking the frame and block headers
+
+    Skippable frames are stepped over. Returns None if the file isn't well-formed zstd.
+    """
+    offsets = []
+    offset = 0
+    while offset < size:
+        inf.seek(offset)
+        header = inf.read(14)
+        if len(header) < 5:
+            return None
+        magic = int.from_bytes(header[:4], 'little')
+        if magic & 0xFFFFFFF0 == 0x184D2A50:
+            offset += 8 + int.from_bytes(header[4:8], 'little')
+            continue
+        if magic != 0xFD2FB528:
+            return None
+        offsets.append(offset)
+        descriptor = header[4]
+        single_segment = descriptor >> 5 & 1
+        content_size_bytes = [single_segment, 2, 4, 8][descriptor >> 6]
+        dictionary_bytes = [0, 1, 2, 4][descriptor & 3]
+        offset += 5 + (not single_segment) + dictionary_bytes + content_size_bytes
+
+        last = False
+        while not last:
+            inf.seek(offset)
+            block = inf.read(3)
+            if len(block) < 3:
+                return None
+            block = int.from_bytes(block, 'little')
+            last = block & 1
+            block_type = block >> 1 & 3
+            if block_type == 3:
+                return None
+            offset += 3 + (1 if block_type == 1 else block >> 3)
+        # Content checksum
+        if descriptor >> 2 & 1:
+            offset += 4
+    return offsets
+
+
+@lru_cache(maxsize=64)
+def cached_members(path, size, mtime):
+    with open(path, 'rb') as inf:
+        if compression(path) == 'gzip':
+            offsets = gzip_members(inf, size)
+        else:
+            offsets = zstd_frames(inf, size)
+    return None if offsets is None else tuple(offsets) + (size,)
+
+
+def compressed_members(path):
+    """Returns the offsets of every gzip member or zstd frame of a file followed by its size,
+    or None if they can't be found without decompressing"""
+    stat = os.stat(path)
+    return cached_members(path, stat.st_size, stat.st_mtime)
+
+
+def iter_compressed_range(path, start, end):
+    """Yields the lines that start in the decompressed members between offsets start and end
+
+    Like the byte ranges of plain files, a line cut by the start of a range belongs to
+    the range before it, which decompresses on past its end to finish the line.
+    """
+    offsets = compressed_members(path)
+    first = bisect.bisect_left(offsets, start)
+    with open(path, 'rb') as inf:
+        def member(i):
+            inf.seek(offsets[i])
+            return decompress(path, inf.read(offsets[i + 1] - offsets[i]))
+
+        # Whether this range starts partway through a line
+        skip = first > 0 and not member(first - 1).endswith(b'\n')
+        buffer = b''
+        for i in range(first, len(offsets) - 1):
+            data = member(i)
+            if offsets[i] >= end:
+                # Past the range: only finish the line it left unfinished, if it did
+                if skip or not buffer:
+                    break
+                newline = data.find(b'\n')
+                buffer += data if newline == -1 else data[:newline]
+                if newline != -1:
+                    break
+                continue
+            buffer += data
+            if skip:
+                newline = buffer.find(b'\n')
+                if newline == -1:
+                    continue
+                buffer = buffer[newline + 1:]
+                skip = False
+            *lines, buffer = buffer.split(b'\n')
+            yield from lines
+        if buffer and not skip:
+            yield buffer
+
+
+def iter_lines(path, start=0, end=None):
+    """Yields the lines of a plain or compressed resource file, or of a range of one"""
+    if compression(path) is not None:
+        if start == 0 and (end is None or end == os.path.getsize(path)):
+            yield from iter_decompressed_lines(path)
+        else:
+            yield from iter_compressed_range(path, start, end)
+        return
+
+    with open(path, 'rb') as inf:
+        if end is None:
+            yield from inf
+            return
+        if start > 0:
+            # Skip the rest of a line the previous range owns
+            inf.seek(start - 1)
+            inf.readline()
+        position = inf.tell()
+        while position < end:
+            line = inf.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def iter_ndjson(path, decoder=None):
+    """Yields the resources in an ndjson file, decoding one line at a time
+
+    Only the current line is held in memory, so peak memory doesn't grow with the
+    file size, and callers can stop early by breaking out of the loop.
+    decoder defaults to DECODER, which decodes whole resources. Compressed files
+    are decompressed on the fly.
+    """
+    decode = (decoder or DECODER).decode
+    for line in iter_lines(path):
+        if line.strip():
+            yield decode(line)
+
+
+def reference_id(reference):
+    """Returns the id from a 'ResourceType/id' reference"""
+    return reference.split('/')[1]
+
+
+def patient_reference(resource):
+    """Returns the patient id a resource references through patient or subject, or None"""
+    if 'patient' in resource:
+        return reference_id(resource['patient']['reference'])
+    elif 'subject' in resource:
+        return reference_id(resource['subject']['reference'])
+    return None
+
+
+def encounter_reference_ids(encounter):
+    """Returns the [(resourceType, id)] of every participant, location and service provider of an encounter"""
+    references = [participant['individual']['reference'] for participant in encounter.get('participant', [])
+                  if 'individual' in participant]
+    references += [location['location']['reference'] for location in encounter.get('location', [])
+                   if 'location' in location]
+    if 'serviceProvider' in encounter:
+        references.append(encounter['serviceProvider']['reference'])
+    return [(reference.split('/')[0], reference_id(reference)) for reference in references]
+
+
+def display_name(resource):
+    """Returns a printable name for a Practitioner, Location or Organization resource"""
+    name = resource.get('name')
+    if isinstance(name, list):
+        name = name[0] if name else {}
+        return ' '.join(name.get('prefix', []) + name.get('given', []) + [name.get('family', '')]).strip()
+    return name
+
+
+def official_name(patient):
+    """Returns the (given, family) of a Patient resource's official name"""
+    for name in patient['name']:
+        if name['use'] == 'official':
+            return name['given'][0], name['family']
+    return None, None
+
+
+def pack_uuid(resource_id):
+    """Returns the 16 bytes of a canonical lowercase UUID id, or None for any other id"""
+    if (len(resource_id) != 36 or resource_id[8] != '-' or resource_id[13] != '-'
+            or resource_id[18] != '-' or resource_id[23] != '-'):
+        return None
+    digits = resource_id.replace('-', '')
+    try:
+        packed = bytes.fromhex(digits)
+    except ValueError:
+        return None
+    # fromhex also takes upper case and spaces, which wouldn't unpack to the same id
+    if len(packed) != 16 or packed.hex() != digits:
+        return None
+    return packed
+
+
+def unpack_uuid(packed):
+    """Returns the id string of 16 bytes from pack_uuid"""
+    digits = bytes(packed).hex()
+    return f'{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}'
+
+
+def intern_id(resource_id):
+    """Returns the key an id is held under: pack_uuid's 16 bytes for a UUID, or else the id itself"""
+    packed = pack_uuid(resource_id) if isinstance(resource_id, str) else None
+    return resource_id if packed is None else packed
+
+
+def external_id(key):
+    """Returns the id string of a key from intern_id"""
+    return unpack_uuid(key) if isinstance(key, bytes) else key
+
+
+def patient_key(resource):
+    """Returns the interned id of the patient a resource references through patient or subject, or None"""
+    patient_id = patient_reference(resource)
+    return None if patient_id is None else intern_id(patient_id)
+
+
+def intern_ids(patient_ids):
+    """Returns a set of ids as a set of interned keys, keeping None for every patient"""
+    return None if patient_ids is None else {intern_id(patient_id) for patient_id in patient_ids}
+
+
+def needle_ids(wanted):
+    """Returns the one wanted patient as a set of its str id for iter_resources to search for, or None"""
+    if wanted is None or len(wanted) != 1:
+        return None
+    return {external_id(key) for key in wanted}
+
+
+class ReferenceCounts(Mapping):
+    """{patient id: {resourceType: count}} for many patients, held as interned ids and count columns
+
+    Each patient is a row keyed on intern_id, so a UUID takes 16 packed bytes rather
+    than a 36 character str, and each resourceType is a column: an array('I') of
+    counts with a row per patient. There's no dict per patient. As a mapping it takes
+    and gives str ids and {resourceType: count} dicts, which are only built for
+    output. Patients whose counts are all zero aren't in it.
+    """
+    def __init__(self):
+        self.rows = {}      # interned patient id -> row
+        self.columns = {}   # resourceType -> array('I') of counts, a row per patient
+
+
+    def row(self, key):
+        """Returns the row of an interned patient id, adding a row of zeros if it's new"""
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = len(self.rows)
+            for counts in self.columns.values():
+                counts.append(0)
+        return row
+
+
+    def column(self, resource_type):
+        """Returns the counts of a resourceType, adding a column of zeros if it's new"""
+        counts = self.columns.get(resource_type)
+        if counts is None:
+            counts = self.columns[resource_type] = array('I', [0]) * len(self.rows)
+        return counts
+
+
+    def add(self, key, resource_type, n=1):
+        """Adds n references from a resourceType to the patient with an interned id"""
+        counts = self.columns.get(resource_type)
+        row = self.rows.get(key)
+        if counts is None or row is None:
+            counts, row = self.column(resource_type), self.row(key)
+        counts[row] += n
+
+
+    def merge(self, other, sign=1):
+        """Adds the counts of another ReferenceCounts, or takes them back out with sign -1"""
+        rows = [self.row(key) for key in other.rows]
+        for resource_type, other_counts in other.columns.items():
+            counts = self.column(resource_type)
+            for row, n in zip(rows, other_counts):
+                if n:
+                    counts[row] += sign * n
+
+
+    def __getitem__(self, patient_id):
+        row = self.rows.get(intern_id(patient_id))
+        counts = {} if row is None else {resource_type: counts[row] for resource_type, counts in self.columns.items()
+                                         if counts[row]}
+        if not counts:
+            raise KeyError(patient_id)
+        return counts
+
+
+    def __iter__(self):
+        return (patient_id for patient_id, _ in self.items())
+
+
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+
+    def items(self):
+        columns = list(self.columns.items())
+        for key, row in self.rows.items():
+            counts = {resource_type: counts[row] for resource_type, counts in columns if counts[row]}
+            if counts:
+                yield external_id(key), counts
+
+
+    def to_json(self):
+        """Returns the counts as JSON-serializable columns"""
+        return {'ids': [external_id(key) for key in self.rows],
+                'columns': {resource_type: counts.tolist() for resource_type, counts in self.columns.items()}}
+
+
+    @classmethod
+    def from_json(cls, saved):
+        """Returns the ReferenceCounts of columns from to_json"""
+        counts = cls()
+        counts.rows = {intern_id(patient_id): row for row, patient_id in enumerate(saved['ids'])}
+        counts.columns = {resource_type: array('I', column) for resource_type, column in saved['columns'].items()}
+        return counts
+
+
+class InternedDict(MutableMapping):
+    """A dict keyed on patient ids that holds them interned, taking and giving str ids"""
+    def __init__(self, items=()):
+        self.data = {}
+        for patient_id, value in items:
+            self[patient_id] = value
+
+
+    def __getitem__(self, patient_id):
+        return self.data[intern_id(patient_id)]
+
+
+    def __setitem__(self, patient_id, value):
+        self.data[intern_id(patient_id)] = value
+
+
+    def __delitem__(self, patient_id):
+        del self.data[intern_id(patient_id)]
+
+
+    def __iter__(self):
+        return map(external_id, self.data)
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def items(self):
+        return ((external_id(key), value) for key, value in self.data.items())
+
+
+def iter_ndjson_range(path, start, end, decoder=None):
+    """Yields the resources on lines that start inside the byte range [start, end)
+
+    Ranges split at arbitrary offsets still cover every line exactly once: a line
+    cut by the start of a range belongs to the range before it. Ranges of compressed
+    files are offsets of their gzip members or zstd frames.
+    """
+    decode = (decoder or DECODER).decode
+    for line in iter_lines(path, start, end):
+        if line.strip():
+            yield decode(line)
+
+
+def iter_candidates(path, needle, start=0, end=None, decoder=None):
+    """Yields the resources on lines in [start, end) that contain the needle bytes
+
+    The file is memory-mapped and searched for the needle, so only the few lines
+    that mention it are JSON-decoded. Callers still check the decoded resource.
+    Compressed files can't be searched in place, so their lines are checked as
+    they are decompressed.
+    """
+    decode = (decoder or DECODER).decode
+    if compression(path) is not None:
+        for line in iter_lines(path, start, end if end is not None else os.path.getsize(path)):
+            if needle in line:
+                yield decode(line)
+        return
+
+    with open(path, 'rb') as inf:
+        size = os.fstat(inf.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = size if end is None else end
+            position = data.find(needle, start)
+            while position != -1:
+                line_start = data.rfind(b'\n', 0, position) + 1
+                if line_start >= end:
+                    break
+                line_end = data.find(b'\n', position)
+                if line_end == -1:
+                    line_end = size
+                # A line that starts before the range belongs to the range before it
+                if line_start >= start:
+                    yield decode(data[line_start:line_end])
+                position = data.find(needle, line_end)
+
+
+def iter_resources(path, start=0, end=None, patient_ids=None, decoder=None):
+    """Yields the resources in a byte range of a file that may reference the wanted patients
+
+    When a single patient is wanted only the lines containing its id are decoded,
+    otherwise every line is.
+    """
+    if patient_ids is not None and len(patient_ids) == 1:
+        (patient_id,) = patient_ids
+        return iter_candidates(path, patient_id.encode(), start, end, decoder)
+    if end is None:
+        return iter_ndjson(path, decoder)
+    return iter_ndjson_range(path, start, end, decoder)
+
+
+def split_ranges(path, start=0, end=None, chunk_size=CHUNK_SIZE):
+    """Splits [start, end) of a file, the whole file by default, into byte ranges of at most chunk_size
+
+    Compressed files are split at gzip member or zstd frame offsets, so ranges can run
+    over chunk_size by up to a member, and a file whose members can't be found
+    without decompressing stays one range.
+    """
+    if end is None:
+        end = os.path.getsize(path)
+    if compression(path) is None:
+        return [(path, offset, min(offset + chunk_size, end)) for offset in range(start, end, chunk_size)]
+
+    offsets = compressed_members(path)
+    if start >= end:
+        return []
+    if offsets is None:
+        return [(path, start, end)]
+    ranges = []
+    for offset in offsets:
+        if start < offset < end and offset - start >= chunk_size:
+            ranges.append((path, start, offset))
+            start = offset
+    ranges.append((path, start, end))
+    return ranges
+
+
+def add_references(resources, wanted, references, encounters, on_patient=None):
+    """Adds each resource's patient/subject reference to the references and encounters ReferenceCounts
+
+    wanted is a set of interned patient ids, or None for every patient.
+    """
+    keys = {}   # patient id -> interned id, as most patients have many resources
+    for resource in resources:
+        resource_type = resource['resourceType']
+        if resource_type == 'Patient' and on_patient is not None:
+            on_patient(resource)
+
+        patient_id = patient_reference(resource)
+        if patient_id is None:
+            continue
+        key = keys.get(patient_id)
+        if key is None:
+            key = keys[patient_id] = intern_id(patient_id)
+        if wanted is not None and key not in wanted:
+            continue
+        references.add(key, resource_type)
+        if resource_type == 'Encounter':
+            for encounter_type, _ in encounter_reference_ids(resource):
+                encounters.add(key, encounter_type)
+
+
+def scan_range(path, start, end, wanted=None):
+    """Counts the references in one byte range of a file. Runs in the worker processes"""
+    references = ReferenceCounts()
+    encounters = ReferenceCounts()
+    add_references(iter_resources(path, start, end, needle_ids(wanted), REFERENCE_DECODER), wanted,
+                   references, encounters)
+    return references, encounters
+
+
+def count_ranges(ranges, patient_ids=None, on_patient=None, workers=1):
+    """Counts the patient/subject references in (path, start, end) byte ranges of files
+
+    With more than one worker, the ranges are split further and counted in a
+    process pool, while Patient.ndjson ranges are read here for on_patient.
+    Yields ((path, start, end), references, encounters) for each range, in order,
+    the counts being ReferenceCounts.
+    """
+    # Resources are matched on interned ids, which are also what's sent to the workers
+    wanted = intern_ids(patient_ids)
+    if workers <= 1:
+        for path, start, end in ranges:
+            references, encounters = ReferenceCounts(), ReferenceCounts()
+            add_references(iter_resources(path, start, end, patient_ids, REFERENCE_DECODER), wanted,
+                           references, encounters, on_patient)
+            yield (path, start, end), references, encounters
+        return
+
+    # At most this many chunks are counting or waiting to be merged at once, so memory stays bounded
+    window = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # [(path, start, end), references, encounters, futures, all chunks submitted], in range order
+        pending = deque()
+        in_flight = 0
+
+        def advance():
+            """Merges the oldest result, returning the oldest range's counts once it's complete"""
+            nonlocal in_flight
+            entry = pending[0]
+            (path, start, end), references, encounters, futures, submitted = entry
+            if futures is None:
+                # Patient.ndjson is read here for on_patient, in range order
+                add_references(iter_resources(path, start, end, patient_ids, REFERENCE_DECODER), wanted,
+                               references, encounters, on_patient)
+                futures = entry[3] = deque()
+            elif futures:
+                partial_references, partial_encounters = futures.popleft().result()
+                in_flight -= 1
+                references.merge(partial_references)
+                encounters.merge(partial_encounters)
+            if submitted and not futures:
+                pending.popleft()
+                return (path, start, end), references, encounters
+            return None
+
+        # Merge in range order so the counts come out the same as a serial scan
+        for path, start, end in ranges:
+            entry = [(path, start, end), ReferenceCounts(), ReferenceCounts(), deque(), False]
+            pending.append(entry)
+            if on_patient is not None and resource_name(path) == 'Patient.ndjson':
+                entry[3] = None
+            else:
+                for chunk in split_ranges(path, start, end):
+                    while in_flight >= window:
+                        counted = advance()
+                        if counted is not None:
+                            yield counted
+                    entry[3].append(executor.submit(scan_range, *chunk, wanted))
+                    in_flight += 1
+            entry[4] = True
+
+        while pending:
+            counted = advance()
+            if counted is not None:
+                yield counted
+
+
+def count_direct_references(patient_ids=None, data_dir=DATA_DIR, on_patient=None, workers=1):
+    """Counts the patient/subject references to many patients in a single pass over the export
+
+    patient_ids is a set of the wanted ids, or None for every patient. on_patient is
+    called with each Patient resource on the way, so names can be picked up in the
+    same pass. workers is the number of processes to count with.
+    Returns (references, encounters) ReferenceCounts, {patient id: {resourceType: count}}
+    as mappings, the second being what the patients' encounters reference.
+    """
+    references = ReferenceCounts()
+    encounters = ReferenceCounts()
+    ranges = [(path, 0, os.path.getsize(path)) for path in resource_files(data_dir)]
+    for _, partial_references, partial_encounters in count_ranges(ranges, patient_ids, on_patient, workers):
+        references.merge(partial_references)
+        encounters.merge(partial_encounters)
+    return references, encounters
+
+
+def add_encounter_references(references, encounters):
+    """Adds the practitioners, locations and organizations each patient's encounters reference"""
+    references.merge(encounters)
+
+
+def count_references(patient_ids=None, data_dir=DATA_DIR, on_patient=None, workers=1):
+    """Counts the references to many patients, including those added by their encounters
+
+    Takes the same arguments as count_direct_references.
+    Returns a ReferenceCounts, {patient id: {resourceType: count}} as a mapping.
+    """
+    references, encounters = count_direct_references(patient_ids, data_dir, on_patient, workers)
+
+    # Encounter references are added after the direct ones, like Patient.lookup_encounters
+    add_encounter_references(references, encounters)
+    return references
+
+
+def indexed_end(path, size):
+    """Returns the offset just past the last complete line of a file"""
+    with open(path, 'rb') as inf:
+        end = size
+        while end > 0:
+            start = max(0, end - CHECKSUM_WINDOW)
+            inf.seek(start)
+            newline = inf.read(end - start).rfind(b'\n')
+            if newline != -1:
+                break
+            end = start
+        else:
+            newline = -1
+        last_newline = start + newline if newline != -1 else -1
+
+        # The last line counts if it's complete JSON without a trailing newline
+        inf.seek(last_newline + 1)
+        tail = inf.read(size - last_newline - 1)
+    if tail.strip():
+        try:
+            json.loads(tail)
+            return size
+        except ValueError:
+            pass
+    return last_newline + 1
+
+
+def checksum(path, offset):
+    """Returns a checksum of the bytes leading up to an offset in a file"""
+    with open(path, 'rb') as inf:
+        start = max(0, offset - CHECKSUM_WINDOW)
+        inf.seek(start)
+        return hashlib.sha1(inf.read(offset - start)).hexdigest()
+
+
+def count_provenance(patient_ids=None, data_dir=DATA_DIR):
+    """Counts each patient's resources from the targets of Provenance.ndjson
+
+    A Provenance resource lists a Patient target and the resources recorded for that
+    patient, so one small file stands in for scanning every resource file. The
+    practitioners, locations and organizations of the listed encounters aren't targets,
+    so they are joined in from Encounter.ndjson, like count_references does.
+    patient_ids is a set of the wanted ids, or None for every patient.
+    Returns a ReferenceCounts, {patient id: {resourceType: count}} as a mapping.
+    """
+    wanted = intern_ids(patient_ids)
+    references = ReferenceCounts()
+    encounter_patients = {}
+    for provenance in iter_resources(resource_file('Provenance.ndjson', data_dir), patient_ids=patient_ids):
+        targets = [target['reference'].split('/') for target in provenance.get('target', [])]
+        patients = [target_id for resource_type, target_id in targets if resource_type == 'Patient']
+        if not patients:
+            continue
+        key = intern_id(patients[0])
+        if wanted is not None and key not in wanted:
+            continue
+
+        for resource_type, target_id in targets:
+            if resource_type != 'Patient':
+                references.add(key, resource_type)
+            if resource_type == 'Encounter':
+                encounter_patients[intern_id(target_id)] = key
+
+    # Encounter references are added after the direct ones, like count_references
+    encounter_path = resource_file('Encounter.ndjson', data_dir)
+    if encounter_patients and os.path.exists(encounter_path):
+        encounters = ReferenceCounts()
+        for encounter in iter_resources(encounter_path, patient_ids=patient_ids, decoder=REFERENCE_DECODER):
+            key = encounter_patients.get(intern_id(encounter.get('id')))
+            if key is None:
+                continue
+            for resource_type, _ in encounter_reference_ids(encounter):
+                encounters.add(key, resource_type)
+        add_encounter_references(references, encounters)
+    return references
+
+
+def verify_provenance(patient_ids=None, workers=1):
+    """Returns [(patient id, resourceType, provenance count, scan count)] wherever the two disagree"""
+    wanted = None if patient_ids is None else set(patient_ids)
+    provenance = count_provenance(wanted)
+    scanned = count_references(wanted, workers=workers)
+
+    differences = []
+    for patient_id in sorted(set(provenance) | set(scanned)):
+        provenance_counts = provenance.get(patient_id, {})
+        scan_counts = scanned.get(patient_id, {})
+        for resource_type in sorted(set(provenance_counts) | set(scan_counts)):
+            if provenance_counts.get(resource_type, 0) != scan_counts.get(resource_type, 0):
+                differences.append((patient_id, resource_type,
+                                    provenance_counts.get(resource_type, 0), scan_counts.get(resource_type, 0)))
+    return differences
+
+
+def edit_distance(a, b, max_distance):
+    """Returns the Levenshtein distance between a and b, or max_distance + 1 once it's exceeded"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class NameIndex:
+    """Patient ids by name, over every name entry (official, maiden, nickname, ...)
+
+    Exact (given, family) lookups are a dict lookup. Case-insensitive prefix search
+    bisects sorted name lists, and typo-tolerant search only checks the names that
+    share enough trigrams with the query. Those structures are built on first use.
+    """
+    def __init__(self, entries=None):
+        self.entries = []  # [given, family, patient id]
+        self.exact = {}    # (given, family) -> [patient ids]
+        self.by_family = None
+        self.by_given = None
+        self.folded = None
+        self.grams = None
+        for given, family, patient_id in entries or []:
+            self.add(given, family, patient_id)
+
+
+    @staticmethod
+    def fold(name):
+        return (name or '').casefold()
+
+
+    def add(self, given, family, patient_id):
+        ids = self.exact.setdefault((given, family), [])
+        if patient_id in ids:
+            return
+        ids.append(patient_id)
+        self.entries.append([given, family, patient_id])
+        self.by_family = self.by_given = self.folded = self.grams = None
+
+
+    def add_patient(self, patient):
+        """Adds every name entry of a Patient resource"""
+        for name in patient.get('name', []):
+            given = name.get('given', [None])[0]
+            self.add(given, name.get('family'), patient['id'])
+
+
+    def lookup(self, first_name, last_name):
+        """Returns the ids of patients with a name entry of exactly this first and last name"""
+        return list(self.exact.get((first_name, last_name), []))
+
+
+    def prefix(self, first_name='', last_name=''):
+        """Returns the ids of patients with a name entry starting with these, ignoring case"""
+        if self.by_family is None:
+            self.by_family = sorted((self.fold(f), self.fold(g), i) for g, f, i in self.entries)
+            self.by_given = sorted((self.fold(g), self.fold(f), i) for g, f, i in self.entries)
+        first_name, last_name = self.fold(first_name), self.fold(last_name)
+        if last_name:
+            keys, key, other = self.by_family, last_name, first_name
+        else:
+            keys, key, other = self.by_given, first_name, last_name
+
+        # Walk forward from the first possible match rather than slicing off the rest of the list,
+        # keeping the first time each patient matched
+        patient_ids = {}
+        n = bisect.bisect_left(keys, (key,))
+        while n < len(keys):
+            name, other_name, patient_id = keys[n]
+            if not name.startswith(key):
+                break
+            if other_name.startswith(other):
+                patient_ids[patient_id] = None
+            n += 1
+        return list(patient_ids)
+
+
+    def fuzzy(self, first_name, last_name, max_distance=2):
+        """Returns [(distance, patient id)] for names within max_distance edits, ignoring case"""
+        if self.grams is None:
+            self.build_grams()
+        query = self.fold(f'{first_name} {last_name}')
+        query_grams = self.trigrams(query)
+
+        # Each edit changes at most three of the query's trigrams, so a name within
+        # max_distance edits must share the rest of them
+        needed = len(query_grams) - 3 * max_distance
+        if needed > 0:
+            shared = {}
+            for gram in query_grams:
+                for n in self.grams.get(gram, ()):
+                    shared[n] = shared.get(n, 0) + 1
+            candidates = [n for n, count in shared.items() if count >= needed]
+        else:
+            candidates = range(len(self.folded))
+
+        matches = {}
+        for n in candidates:
+            name, patient_ids = self.folded[n]
+            distance = edit_distance(query, name, max_distance)
+            if distance <= max_distance:
+                for patient_id in patient_ids:
+                    matches[patient_id] = min(distance, matches.get(patient_id, distance))
+        return sorted((distance, patient_id) for patient_id, distance in matches.items())
+
+
+    @staticmethod
+    def trigrams(name):
+        padded = f'^^{name}$$'
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+    def build_grams(self):
+        """Builds the trigram -> name postings that fuzzy narrows its candidates with"""
+        names = {}
+        for given, family, patient_id in self.entries:
+            names.setdefault(self.fold(f'{given} {family}'), []).append(patient_id)
+        self.folded = list(names.items())
+        self.grams = {}
+        for n, (name, _) in enumerate(self.folded):
+            for gram in self.trigrams(name):
+                self.grams.setdefault(gram, []).append(n)
+
+
+@contextmanager
+def new_database(path):
+    """Yields a connection to a new SQLite database, which replaces the one at path once it's written
+
+    The new database is written beside the old one and moved over it, so anything
+    still reading the old one isn't disturbed.
+    """
+    new_path = path + '.new'
+    if os.path.exists(new_path):
+        os.remove(new_path)
+    connection = sqlite3.connect(new_path)
+    try:
+        with connection:
+            yield connection
+            connection.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+    finally:
+        connection.close()
+    os.replace(new_path, path)
+
+
+def open_database(path):
+    """Returns a read-only connection to a database from new_database, or None if it's missing or outdated"""
+    if not os.path.exists(path):
+        return None
+    # Reports are answered from serve's threads, which only ever read
+    connection = sqlite3.connect(f'file:{os.path.abspath(path)}?mode=ro', uri=True, check_same_thread=False)
+    if connection.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+        connection.close()
+        return None
+    return connection
+
+
+class IndexTable(Mapping):
+    """A read-only {patient id: value} view of one table of a saved ReferenceIndex
+
+    Looking up a patient reads just their row, and items() reads the whole table in
+    one query. Rows are keyed on intern_id, and decode turns a row's value columns
+    into what an in-memory index holds.
+    """
+    def __init__(self, connection, table, columns, decode):
+        self.connection = connection
+        self.table = table
+        self.columns = columns
+        self.decode = decode
+
+
+    def __getitem__(self, patient_id):
+        row = self.connection.execute(f'SELECT {self.columns} FROM {self.table} WHERE patient_key = ?',
+                                      (intern_id(patient_id),)).fetchone()
+        if row is None:
+            raise KeyError(patient_id)
+        return self.decode(row)
+
+
+    def __iter__(self):
+        return (external_id(key) for (key,) in self.connection.execute(
+            f'SELECT patient_key FROM {self.table} ORDER BY rowid'))
+
+
+    def __len__(self):
+        return self.connection.execute(f'SELECT count(*) FROM {self.table}').fetchone()[0]
+
+
+    def items(self):
+        return ((external_id(row[0]), self.decode(row[1:])) for row in self.connection.execute(
+            f'SELECT patient_key, {self.columns} FROM {self.table} ORDER BY rowid'))
+
+
+class ReferenceIndex:
+    """On-disk index of resource counts per patient, and patient ids per name
+
+    Built once with a single scan of the export (`1up.py build-index`), after which
+    Patient answers from the index instead of re-reading every ndjson file. It's
+    saved in SQLite keyed on patient id and name, so a report reads one patient's
+    rows rather than loading the whole index.
+
+    The index records each file's size, mtime, how far it was indexed and a checksum
+    of the bytes before that offset, along with the counts it contributed. Running
+    build-index again only reads what changed: bytes appended since the last run are
+    indexed on their own, and files that were rewritten or removed have their old
+    counts taken out before being indexed again from the start. Those records are
+    saved apart from the index, since only refresh reads them.
+
+    Patient ids are held interned, as ReferenceCounts and InternedDict keys in memory
+    and intern_id keys in SQLite.
+    """
+    def __init__(self, references=None, names=None, patients=None, files=None):
+        self.references = references or ReferenceCounts()   # patient id -> {resourceType: count}
+        self.names = names or NameIndex()
+        self.patients = patients or InternedDict()          # patient id -> [given, family]
+        self.files = files or {}                            # file name -> what was indexed from it
+        self.connection = None                              # what a loaded index reads its rows from
+
+
+    @classmethod
+    def build(cls, data_dir=DATA_DIR, workers=1):
+        """Scans every resource file once and returns the index"""
+        index = cls()
+        index.refresh(data_dir, workers)
+        return index
+
+
+    def refresh(self, data_dir=DATA_DIR, workers=1):
+        """Brings the index up to date with the resource files, reading only what changed"""
+        if self.files is None:
+            raise ValueError('The index was loaded without its file records, so it can\'t be refreshed')
+        ranges = []
+        resource_paths = resource_files(data_dir)
+        for resource_path in resource_paths:
+            name = os.path.basename(resource_path)
+            stat = os.stat(resource_path)
+            indexed = self.files.get(name)
+            if indexed is not None and (indexed['size'], indexed['mtime']) == (stat.st_size, stat.st_mtime):
+                continue
+
+            start = 0
+            if indexed is not None:
+                # Compressed files can't be appended to in place, so any change is a rewrite
+                if (compression(resource_path) is None and stat.st_size >= indexed['offset']
+                        and checksum(resource_path, indexed['offset']) == indexed['checksum']):
+                    # Appended to: only the new bytes need indexing
+                    start = indexed['offset']
+                else:
+                    # Rewritten: take out what it contributed and start again
+                    self.remove_file(name)
+                    indexed = None
+            if indexed is None:
+                indexed = self.files[name] = {'references': ReferenceCounts(), 'patients': []}
+
+            end = indexed_end(resource_path, stat.st_size) if compression(resource_path) is None else stat.st_size
+            indexed.update(size=stat.st_size, mtime=stat.st_mtime, offset=end,
+                           checksum=checksum(resource_path, end))
+            ranges.append((resource_path, start, end))
+
+        for name in set(self.files) - {os.path.basename(path) for path in resource_paths}:
+            self.remove_file(name)
+
+        for (path, _, _), references, encounters in count_ranges(ranges, on_patient=self.add_patient,
+                                                                 workers=workers):
+            add_encounter_references(references, encounters)
+            self.files[os.path.basename(path)]['references'].merge(references)
+            self.references.merge(references)
+
+
+    def remove_file(self, name):
+        """Takes the counts and patients a file contributed back out of the index"""
+        indexed = self.files.pop(name)
+        self.references.merge(indexed['references'], -1)
+
+        removed = set(indexed['patients'])
+        if removed:
+            for key in removed:
+                self.patients.pop(external_id(key), None)
+            self.names = NameIndex([entry for entry in self.names.entries if intern_id(entry[2]) not in removed])
+
+
+    def add_patient(self, patient):
+        """Adds a Patient resource to the name lookups"""
+        first_name, last_name = official_name(patient)
+        self.patients[patient['id']] = [first_name, last_name]
+        self.names.add_patient(patient)
+        patient_files = [name for name in self.files if resource_name(name) == 'Patient.ndjson']
+        if patient_files:
+            # Patients come from Patient.ndjson, so they leave the index with it
+            self.files[patient_files[0]]['patients'].append(intern_id(patient['id']))
+
+
+    def lookup_name(self, first_name, last_name):
+        """Returns the patient ids with this first and last name"""
+        if self.names is None:
+            return [external_id(key) for (key,) in self.connection.execute(
+                'SELECT patient_key FROM names WHERE given IS ? AND family IS ? ORDER BY rowid',
+                (first_name, last_name))]
+        return self.names.lookup(first_name, last_name)
+
+
+    def name_index(self):
+        """Returns the NameIndex, reading every name entry of a loaded index the first time"""
+        if self.names is None:
+            self.names = NameIndex((given, family, external_id(key)) for given, family, key in self.connection.execute(
+                'SELECT given, family, patient_key FROM names ORDER BY rowid'))
+        return self.names
+
+
+    def save(self, path=INDEX_PATH, files_path=INDEX_FILES_PATH):
+        if self.files is not None:
+            files = {name: dict(indexed, references=indexed['references'].to_json(),
+                                patients=[external_id(key) for key in indexed['patients']])
+                     for name, indexed in self.files.items()}
+            with open(files_path, 'w') as outf:
+                json.dump({'version': INDEX_VERSION, 'files': files}, outf, separators=(',', ':'))
+
+        # Keys are intern_id's, a 16 byte blob for a UUID
+        with new_database(path) as connection:
+            connection.execute('CREATE TABLE counts (patient_key UNIQUE, counts TEXT)')
+            connection.execute('CREATE TABLE patients (patient_key UNIQUE, given TEXT, family TEXT)')
+            connection.execute('CREATE TABLE names (given TEXT, family TEXT, patient_key)')
+            connection.executemany('INSERT INTO counts VALUES (?, ?)',
+                                   ((intern_id(patient_id), json.dumps(counts, separators=(',', ':')))
+                                    for patient_id, counts in self.references.items()))
+            connection.executemany('INSERT INTO patients VALUES (?, ?, ?)',
+                                   ((intern_id(patient_id), given, family)
+                                    for patient_id, (given, family) in self.patients.items()))
+            connection.executemany('INSERT INTO names VALUES (?, ?, ?)',
+                                   ((given, family, intern_id(patient_id))
+                                    for given, family, patient_id in self.name_index().entries))
+            connection.execute('CREATE INDEX names_given_family ON names (given, family)')
+
+
+    @classmethod
+    def load(cls, path=INDEX_PATH, files_path=None):
+        """Returns the saved index, or None if it hasn't been built or needs rebuilding
+
+        Without files_path the index is read a row at a time as patients and names are
+        looked up, and can't be refreshed. With it, the index and its file records are
+        read in full for refresh.
+        """
+        if files_path is not None and not os.path.exists(files_path):
+            return None
+        connection = open_database(path)
+        if connection is None:
+            return None
+
+        index = cls()
+        index.references = IndexTable(connection, 'counts', 'counts', lambda row: json.loads(row[0]))
+        index.patients = IndexTable(connection, 'patients', 'given, family', list)
+        index.names = None
+        index.files = None
+        index.connection = connection
+        if files_path is None:
+            return index
+
+        with open(files_path, 'r') as inf:
+            saved_files = json.load(inf)
+        if saved_files.get('version') != INDEX_VERSION:
+            connection.close()
+            return None
+        references = ReferenceCounts()
+        for patient_id, counts in index.references.items():
+            key = intern_id(patient_id)
+            for resource_type, n in counts.items():
+                references.add(key, resource_type, n)
+        index.references = references
+        index.patients = InternedDict(index.patients.items())
+        index.name_index()
+        index.files = {name: dict(indexed, references=ReferenceCounts.from_json(indexed['references']),
+                                  patients=[intern_id(patient_id) for patient_id in indexed['patients']])
+                       for name, indexed in saved_files['files'].items()}
+        connection.close()
+        index.connection = None
+        return index
+
+
+class IdColumn:
+    """A column of FHIR ids interned into dense integer codes, in id order
+
+    Canonical lowercase UUIDs, nearly every id in a bulk export, are held as 16 packed
+    bytes in a bytearray or a NumPy 'S16' array, with no Python object per id.
+    Interning sorts and deduplicates with np.unique, so codes are positions in the
+    sorted labels. Once an id that isn't a UUID is seen, the column falls back to
+    byte strings. Ids are only turned back into str for output.
+    """
+    def __init__(self, labels=None, packed=True):
+        self.labels = labels            # interned ids, sorted: 'S16' packed UUIDs, or 'S' ids
+        self.packed = packed
+        self.pending = bytearray()      # ids appended since the last intern, 16 bytes each
+        self.pending_ids = []           # the same, once the column holds ids that aren't UUIDs
+
+
+    def __len__(self):
+        interned = 0 if self.labels is None else len(self.labels)
+        return interned + len(self.pending) // 16 + len(self.pending_ids)
+
+
+    def append(self, resource_id):
+        """Appends an id; it is given a code by the next intern()"""
+        self.append_key(intern_id(resource_id))
+
+
+    def append_key(self, key):
+        """Appends an id already interned with intern_id"""
+        if self.packed:
+            if isinstance(key, bytes):
+                self.pending += key
+                return
+            self.unpack()
+        self.pending_ids.append(external_id(key))
+
+
+    def unpack(self):
+        """Switches the column to holding ids as byte strings"""
+        if self.labels is not None:
+            self.labels = np.array([i.encode() for i in self.ids()], dtype=bytes)
+        self.pending_ids = [unpack_uuid(self.pending[i:i + 16]) for i in range(0, len(self.pending), 16)]
+        self.pending = bytearray()
+        self.packed = False
+
+
+    def intern(self):
+        """Interns the pending ids and returns the code of every id in the column, earlier labels first"""
+        if self.packed:
+            pending = np.frombuffer(bytes(self.pending), dtype='S16')
+        else:
+            pending = np.array([i.encode() for i in self.pending_ids], dtype=bytes)
+        values = pending if self.labels is None else np.concatenate([self.labels, pending])
+        self.labels, codes = np.unique(values, return_inverse=True)
+        self.pending = bytearray()
+        self.pending_ids = []
+        return codes.reshape(-1)
+
+
+    def find(self, resource_id):
+        """Returns the code of an interned id, or None"""
+        if self.labels is None:
+            return None
+        key = pack_uuid(resource_id) if self.packed else resource_id.encode()
+        # A key wider than the column can't be in it, and converting it would truncate it to a stored prefix
+        if key is None or len(key) > self.labels.dtype.itemsize:
+            return None
+        label = np.array(key, dtype=self.labels.dtype)
+        code = int(np.searchsorted(self.labels, label))
+        if code < len(self.labels) and self.labels[code] == label:
+            return code
+        return None
+
+
+    def ids(self, codes=None):
+        """Returns the interned ids as str, for every code or the given ones"""
+        labels = self.labels if codes is None else self.labels[codes]
+        if not self.packed:
+            return labels.astype(str).tolist()
+        # tobytes keeps the trailing zero bytes that indexing an 'S16' array strips
+        packed = labels.tobytes()
+        return [unpack_uuid(packed[i:i + 16]) for i in range(0, len(packed), 16)]
+
+
+class EdgeStore:
+    """Columnar (resource type, resource id, patient id) reference edges for the whole export
+
+    Built once from every ndjson file (`1up.py build-edges`) into dictionary-encoded
+    NumPy arrays, sorted by patient, so counts are vectorized group-bys over integer
+    codes instead of re-parsing JSON. Label arrays are sorted, so a label's code is
+    found with a binary search. Resource and patient ids are IdColumns. The sizes and
+    mtimes of the files are saved with the edges, so current() can tell when they changed.
+    """
+    def __init__(self, type_labels, resources, patients, type_codes, resource_codes, patient_indptr, sources=None):
+        self.type_labels = type_labels          # resourceType per type code
+        self.resources = resources              # IdColumn of resource ids
+        self.patients = patients                # IdColumn of patient ids
+        self.type_codes = type_codes            # per edge, grouped by patient
+        self.resource_codes = resource_codes    # per edge, grouped by patient
+        self.patient_indptr = patient_indptr    # a patient's edges are [indptr[code], indptr[code + 1])
+        self.sources = sources or {}            # file name -> [size, mtime] when built
+
+
+    @staticmethod
+    def stat_sources(data_dir=DATA_DIR):
+        sources = {}
+        for path in resource_files(data_dir):
+            stat = os.stat(path)
+            sources[os.path.basename(path)] = [stat.st_size, stat.st_mtime]
+        return sources
+
+
+    @classmethod
+    def build(cls, data_dir=DATA_DIR):
+        """Extracts the reference edges from every resource file in one pass"""
+        if np is None:
+            raise ImportError('The edge store needs numpy: pip install numpy')
+        sources = cls.stat_sources(data_dir)
+        type_codes = {}
+        edge_types = array('H')
+        resources = IdColumn()
+        patients = IdColumn()
+
+        def add_edge(resource_type, resource_id, key):
+            edge_types.append(type_codes.setdefault(resource_type, len(type_codes)))
+            resources.append(resource_id)
+            patients.append_key(key)
+
+        for resource_path in resource_files(data_dir):
+            for resource in iter_ndjson(resource_path, REFERENCE_DECODER):
+                key = patient_key(resource)
+                if key is None:
+                    continue
+                add_edge(resource['resourceType'], resource['id'], key)
+                if resource['resourceType'] == 'Encounter':
+                    for resource_type, resource_id in encounter_reference_ids(resource):
+                        add_edge(resource_type, resource_id, key)
+
+        # Recode the types so their labels are sorted; the id columns come out sorted
+        labels = np.array(list(type_codes), dtype=bytes)
+        order = np.argsort(labels, kind='stable')
+        recode = np.empty(len(order), dtype=np.uint16)
+        recode[order] = np.arange(len(order), dtype=np.uint16)
+        edge_types = recode[np.frombuffer(edge_types, dtype=np.uint16)]
+        resource_codes = resources.intern().astype(np.uint32)
+        patient_codes = patients.intern()
+
+        by_patient = np.argsort(patient_codes, kind='stable')
+        patient_indptr = np.zeros(len(patients) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(patient_codes, minlength=len(patients)), out=patient_indptr[1:])
+        return cls(labels[order], resources, patients,
+                   edge_types[by_patient], resource_codes[by_patient], patient_indptr, sources)
+
+
+    @classmethod
+    def current(cls, data_dir=DATA_DIR, path=EDGES_PATH):
+        """Returns the saved edge store, rebuilding and saving it first if the resource files changed
+
+        Returns None if it hasn't been built, so callers can count another way.
+        """
+        edges = cls.load(path)
+        if edges is not None and edges.sources != cls.stat_sources(data_dir):
+            edges = cls.build(data_dir)
+            edges.save(path)
+        return edges
+
+
+    def save(self, path=EDGES_PATH):
+        with open(path, 'wb') as outf:
+            np.savez(outf,
+                     type_labels=self.type_labels,
+                     resource_labels=self.resources.labels,
+                     resources_packed=self.resources.packed,
+                     patient_labels=self.patients.labels,
+                     patients_packed=self.patients.packed,
+                     type_codes=self.type_codes,
+                     resource_codes=self.resource_codes,
+                     patient_indptr=self.patient_indptr,
+                     source_names=np.array(list(self.sources), dtype=str),
+                     source_sizes=np.array([size for size, _ in self.sources.values()], dtype=np.int64),
+                     source_mtimes=np.array([mtime for _, mtime in self.sources.values()], dtype=np.float64))
+
+
+    @classmethod
+    def load(cls, path=EDGES_PATH):
+        """Returns the saved edge store, or None if it hasn't been built"""
+        if not os.path.exists(path):
+            return None
+        if np is None:
+            raise ImportError('The edge store needs numpy: pip install numpy')
+        saved = np.load(path)
+        # Stores built before ids were packed have plain id labels
+        packed = {column: bool(saved[f'{column}_packed']) if f'{column}_packed' in saved.files else False
+                  for column in ('resources', 'patients')}
+        # Stores built before their sources were saved have none, so current() rebuilds them
+        sources = {}
+        if 'source_names' in saved.files:
+            sources = {str(name): [int(size), float(mtime)] for name, size, mtime in
+                       zip(saved['source_names'], saved['source_sizes'], saved['source_mtimes'])}
+        return cls(saved['type_labels'],
+                   IdColumn(saved['resource_labels'], packed['resources']),
+                   IdColumn(saved['patient_labels'], packed['patients']),
+                   saved['type_codes'], saved['resource_codes'], saved['patient_indptr'], sources)
+
+
+    def patient_code(self, patient_id):
+        """Returns a patient's code, or None if nothing references it"""
+        return self.patients.find(patient_id)
+
+
+    def type_counts(self, type_codes):
+        """Returns {resourceType: count} for an array of type codes"""
+        counts = np.bincount(type_codes, minlength=len(self.type_labels))
+        return {self.type_labels[code].decode(): int(counts[code]) for code in np.flatnonzero(counts)}
+
+
+    def patient_counts(self, patient_id):
+        """Returns {resourceType: count} of the references to one patient"""
+        code = self.patient_code(patient_id)
+        if code is None:
+            return {}
+        return self.type_counts(self.type_codes[self.patient_indptr[code]:self.patient_indptr[code + 1]])
+
+
+    def cohort_counts(self, patient_ids):
+        """Returns {resourceType: count} of the references to every patient in a cohort"""
+        codes = [code for code in map(self.patient_code, patient_ids) if code is not None]
+        if not codes:
+            return {}
+        return self.type_counts(np.concatenate([self.type_codes[self.patient_indptr[code]:self.patient_indptr[code + 1]]
+                                                for code in codes]))
+
+
+    def population_counts(self):
+        """Returns (patient ids, resourceTypes, patient x resourceType count matrix) for every patient"""
+        patient_codes = np.repeat(np.arange(len(self.patients)), np.diff(self.patient_indptr))
+        counts = np.bincount(patient_codes * len(self.type_labels) + self.type_codes,
+                             minlength=len(self.patients) * len(self.type_labels))
+        return (self.patients.ids(), self.type_labels.astype(str),
+                counts.reshape(len(self.patients), len(self.type_labels)))
+
+
+class CountMatrix:
+    """Sparse patient x resourceType reference count matrix for the whole export
+
+    Partial counts from each scanned byte range are packed into (row << 16 | column)
+    keys and merged into sorted key/count arrays, so memory grows with the nonzero
+    cells rather than the number of resources. Merges wait until the pending keys are
+    as many as the merged ones, which keeps the total merge work linear.
+
+    Rows are an IdColumn: each partial appends its patients as new rows, and a merge
+    interns them, recoding the keys onto the sorted, deduplicated patient ids.
+    """
+    def __init__(self):
+        self.rows = IdColumn()
+        self.columns = {}           # resourceType -> column code, in the order first seen
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending_keys = array('Q')
+        self.pending_counts = array('q')
+
+
+    def add_patient(self, patient_id):
+        """Gives a patient a row even if nothing references it"""
+        self.rows.append(patient_id)
+
+
+    def add(self, partial):
+        """Adds the counts of a ReferenceCounts, whose rows become new rows here"""
+        first_row = len(self.rows)
+        for key in partial.rows:
+            self.rows.append_key(key)
+        for resource_type, counts in partial.columns.items():
+            column = self.columns.setdefault(resource_type, len(self.columns))
+            for row, n in enumerate(counts):
+                if n:
+                    self.pending_keys.append((first_row + row) << 16 | column)
+                    self.pending_counts.append(n)
+        if len(self.pending_keys) >= max(len(self.keys), 1 << 20):
+            self.merge()
+
+
+    def merge(self):
+        rows = self.rows.intern().astype(np.uint64)
+        keys = np.concatenate([self.keys, np.frombuffer(self.pending_keys, dtype=np.uint64)])
+        keys = rows[(keys >> np.uint64(16)).astype(np.int64)] << np.uint64(16) | (keys & np.uint64(0xFFFF))
+        counts = np.concatenate([self.counts, np.frombuffer(self.pending_counts, dtype=np.int64)])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.zeros(len(self.keys), dtype=np.int64)
+        np.add.at(self.counts, inverse.reshape(-1), counts)
+        self.pending_keys = array('Q')
+        self.pending_counts = array('q')
+
+
+    def csr(self):
+        """Returns (indptr, indices, data, row labels, column labels) with both label arrays sorted"""
+        self.merge()
+        column_labels = np.array(list(self.columns), dtype=bytes)
+        order = np.argsort(column_labels, kind='stable')
+        recode = np.empty(len(order), dtype=np.int64)
+        recode[order] = np.arange(len(order))
+
+        # Keys are sorted by row already, and the rows are in patient id order
+        rows = (self.keys >> np.uint64(16)).astype(np.int64)
+        columns = recode[(self.keys & np.uint64(0xFFFF)).astype(np.int64)]
+        order_in_row = np.lexsort((columns, rows))
+        indptr = np.zeros(len(self.rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.rows)), out=indptr[1:])
+        return (indptr, columns[order_in_row].astype(np.int32), self.counts[order_in_row],
+                np.array(self.rows.ids(), dtype=str), column_labels[order].astype(str))
+
+
+    def save(self, path=MATRIX_PATH):
+        """Writes the matrix as an npz that scipy.sparse.load_npz can also read"""
+        indptr, indices, data, row_labels, column_labels = self.csr()
+        with open(path, 'wb') as outf:
+            np.savez(outf, format=b'csr', shape=np.array([len(row_labels), len(column_labels)]),
+                     indptr=indptr, indices=indices, data=data,
+                     row_labels=row_labels, column_labels=column_labels)
+
+
+def export_matrix(path=MATRIX_PATH, data_dir=DATA_DIR, workers=1):
+    """Counts every patient's references in one pass and writes them as a sparse CSR matrix
+
+    Every file is read in CHUNK_SIZE byte ranges, so no more than one range's
+    per-patient counts are held at a time, as a ReferenceCounts. Patients with no
+    references still get an empty row.
+    """
+    if np is None:
+        raise ImportError('The matrix export needs numpy: pip install numpy')
+    matrix = CountMatrix()
+    ranges = [chunk for path in resource_files(data_dir) for chunk in split_ranges(path)]
+    for _, references, encounters in count_ranges(ranges, on_patient=lambda patient: matrix.add_patient(patient['id']),
+                                                  workers=workers):
+        matrix.add(references)
+        matrix.add(encounters)
+    matrix.save(path)
+
+
+class EncounterIndex:
+    """Cached join of each patient's encounters to the practitioners, locations and organizations they reference
+
+    Built with one pass over Encounter.ndjson, joined against the Practitioner,
+    Location and Organization files for display names, and saved next to the data
+    in SQLite keyed on the patient's intern_id. A loaded index reads just the
+    patient's own encounters and the names of the entities in them.
+    """
+    def __init__(self, encounters=None, entities=None, sources=None):
+        self.encounters = encounters or {}  # patient intern_id -> {encounter id: [[resourceType, id]]}
+        self.entities = entities or {}      # 'resourceType/id' -> display name
+        self.sources = sources or {}        # file name -> [size, mtime] when built
+        self.connection = None              # what a loaded index reads its rows from
+
+
+    @staticmethod
+    def stat_sources(data_dir=DATA_DIR):
+        sources = {}
+        for name in ['Encounter.ndjson'] + ENTITY_FILES:
+            path = resource_file(name, data_dir)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                sources[os.path.basename(path)] = [stat.st_size, stat.st_mtime]
+        return sources
+
+
+    @classmethod
+    def build(cls, data_dir=DATA_DIR):
+        index = cls(sources=cls.stat_sources(data_dir))
+        for name in ENTITY_FILES:
+            path = resource_file(name, data_dir)
+            if os.path.exists(path):
+                for resource in iter_ndjson(path):
+                    index.entities[f"{resource['resourceType']}/{resource['id']}"] = display_name(resource)
+
+        for encounter in iter_ndjson(resource_file('Encounter.ndjson', data_dir)):
+            key = patient_key(encounter)
+            if key is not None:
+                index.encounters.setdefault(key, {})[encounter['id']] = encounter_reference_ids(encounter)
+        return index
+
+
+    @classmethod
+    def current(cls, data_dir=DATA_DIR, path=ENCOUNTERS_PATH):
+        """Returns the saved index, rebuilding and saving it first if its source files changed"""
+        index = cls.load(path)
+        if index is None or index.sources != cls.stat_sources(data_dir):
+            index = cls.build(data_dir)
+            index.save(path)
+        return index
+
+
+    def patient_encounters(self, patient_id):
+        """Returns {encounter id: [[resourceType, id]]} of a patient's encounters"""
+        if self.connection is None:
+            return self.encounters.get(intern_id(patient_id), {})
+        return {encounter_id: json.loads(references) for encounter_id, references in self.connection.execute(
+            'SELECT encounter_id, refs FROM encounters WHERE patient_key = ? ORDER BY rowid', (intern_id(patient_id),))}
+
+
+    def entity_name(self, resource_type, resource_id):
+        """Returns the display name of a practitioner, location or organization, or None"""
+        key = f'{resource_type}/{resource_id}'
+        if self.connection is None:
+            return self.entities.get(key)
+        row = self.connection.execute('SELECT name FROM entities WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def patient_entities(self, patient_id):
+        """Returns [(resourceType, id, name, references)] of the distinct entities in a patient's encounters"""
+        counts = {}
+        for references in self.patient_encounters(patient_id).values():
+            for resource_type, resource_id in references:
+                key = (resource_type, resource_id)
+                counts[key] = counts.get(key, 0) + 1
+        return sorted(((resource_type, resource_id, self.entity_name(resource_type, resource_id), n)
+                       for (resource_type, resource_id), n in counts.items()),
+                      key=lambda x: (x[0], -x[3], x[1]))
+
+
+    def save(self, path=ENCOUNTERS_PATH):
+        with new_database(path) as connection:
+            connection.execute('CREATE TABLE encounters (patient_key, encounter_id TEXT, refs TEXT)')
+            connection.execute('CREATE TABLE entities (key TEXT PRIMARY KEY, name TEXT)')
+            connection.execute('CREATE TABLE sources (name TEXT PRIMARY KEY, size INTEGER, mtime REAL)')
+            connection.executemany('INSERT INTO encounters VALUES (?, ?, ?)',
+                                   ((key, encounter_id, json.dumps(references, separators=(',', ':')))
+                                    for key, encounters in self.encounters.items()
+                                    for encounter_id, references in encounters.items()))
+            connection.executemany('INSERT INTO entities VALUES (?, ?)', self.entities.items())
+            connection.executemany('INSERT INTO sources VALUES (?, ?, ?)',
+                                   ((name, size, mtime) for name, (size, mtime) in self.sources.items()))
+            connection.execute('CREATE INDEX encounters_patient_key ON encounters (patient_key)')
+
+
+    @classmethod
+    def load(cls, path=ENCOUNTERS_PATH):
+        """Returns the saved index, which reads patients' rows as they're asked for, or None if it hasn't been built"""
+        connection = open_database(path)
+        if connection is None:
+            return None
+        index = cls(sources={name: [size, mtime] for name, size, mtime in connection.execute(
+            'SELECT name, size, mtime FROM sources')})
+        index.connection = connection
+        return index
+
+
+def iter_reference_targets(value):
+    """Yields the (resourceType, id) of every 'reference' anywhere inside a decoded resource
+
+    Relative and absolute 'Type/id' references count, with any '/_history/...' version
+    dropped. Contained ('#id') and urn references aren't resources in the export.
+    """
+    if isinstance(value, dict):
+        for key, child in value.items():
+            if key == 'reference' and isinstance(child, str):
+                reference = child.split('/_history/')[0]
+                parts = reference.rsplit('/', 2)
+                if len(parts) >= 2 and parts[-2] and parts[-1] and ':' not in parts[-2]:
+                    yield parts[-2], parts[-1]
+            else:
+                yield from iter_reference_targets(child)
+    elif isinstance(value, list):
+        for child in value:
+            yield from iter_reference_targets(child)
+
+
+class ReferenceGraph:
+    """Adjacency index over every reference between resources in the export
+
+    Built once (`1up.py build-graph`) from every 'reference' field of every resource.
+    A node is a (resourceType, id) pair, coded as id code * number of types + type
+    code, with the ids in an IdColumn. The edges are stored both ways as CSR arrays
+    of node codes, so linked() walks them in memory instead of rescanning the files.
+    """
+    def __init__(self, type_labels, ids, node_keys, indptr, indices):
+        self.type_labels = type_labels      # resourceType per type code, sorted
+        self.ids = ids                      # IdColumn of resource ids
+        self.node_keys = node_keys          # id code * len(type_labels) + type code per node, sorted
+        self.indptr = indptr                # a node's neighbours are indices[indptr[node]:indptr[node + 1]]
+        self.indices = indices
+
+
+    @classmethod
+    def build(cls, data_dir=DATA_DIR):
+        """Collects the references of every resource in one pass"""
+        if np is None:
+            raise ImportError('The reference graph needs numpy: pip install numpy')
+        type_codes = {}
+        edge_types = array('H')     # source type, target type for each edge
+        ids = IdColumn()            # source id, target id for each edge
+        for resource_path in resource_files(data_dir):
+            for resource in iter_ndjson(resource_path):
+                source_type = type_codes.setdefault(resource['resourceType'], len(type_codes))
+                for target_type, target_id in iter_reference_targets(resource):
+                    edge_types.append(source_type)
+                    edge_types.append(type_codes.setdefault(target_type, len(type_codes)))
+                    ids.append(resource['id'])
+                    ids.append(target_id)
+
+        # Recode the types so their labels are sorted, then number the (type, id) nodes
+        type_labels = np.array(list(type_codes), dtype=bytes)
+        order = np.argsort(type_labels, kind='stable')
+        recode = np.empty(max(len(order), 1), dtype=np.int64)
+        recode[order] = np.arange(len(order))
+        keys = ids.intern().astype(np.int64) * len(type_labels) + recode[np.frombuffer(edge_types, dtype=np.uint16)]
+        node_keys, nodes = np.unique(keys, return_inverse=True)
+        sources, targets = nodes.reshape(-1)[0::2], nodes.reshape(-1)[1::2]
+
+        # Both directions, so a patient reaches what references it and what that references
+        ends = np.concatenate([sources, targets])
+        neighbours = np.concatenate([targets, sources])
+        by_node = np.argsort(ends, kind='stable')
+        indptr = np.zeros(len(node_keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ends, minlength=len(node_keys)), out=indptr[1:])
+        return cls(type_labels[order], ids, node_keys, indptr, neighbours[by_node].astype(np.uint32))
+
+
+    def save(self, path=GRAPH_PATH):
+        with open(path, 'wb') as outf:
+            np.savez(outf,
+                     type_labels=self.type_labels,
+                     id_labels=self.ids.labels,
+                     ids_packed=self.ids.packed,
+                     node_keys=self.node_keys,
+                     indptr=self.indptr,
+                     indices=self.indices)
+
+
+    @classmethod
+    def load(cls, path=GRAPH_PATH):
+        """Returns the saved graph, or None if it hasn't been built"""
+        if not os.path.exists(path):
+            return None
+        if np is None:
+            raise ImportError('The reference graph needs numpy: pip install numpy')
+        saved = np.load(path)
+        return cls(saved['type_labels'], IdColumn(saved['id_labels'], bool(saved['ids_packed'])),
+                   saved['node_keys'], saved['indptr'], saved['indices'])
+
+
+    def node(self, resource_type, resource_id):
+        """Returns the code of a resource's node, or None if no reference touches it"""
+        label = resource_type.encode()
+        type_code = int(np.searchsorted(self.type_labels, label))
+        id_code = self.ids.find(resource_id)
+        if id_code is None or type_code == len(self.type_labels) or self.type_labels[type_code] != label:
+            return None
+        key = id_code * len(self.type_labels) + type_code
+        code = int(np.searchsorted(self.node_keys, key))
+        if code < len(self.node_keys) and self.node_keys[code] == key:
+            return code
+        return None
+
+
+    def linked(self, patient_id, hops=2, stop_types=HUB_TYPES):
+        """Returns {resourceType: [ids]} of every resource within hops references of a patient
+
+        Resources of stop_types, such as other patients and shared practitioners or
+        medications, are included but not walked through, or everything would link
+        to everything through them.
+        """
+        start = self.node('Patient', patient_id)
+        if start is None:
+            return {}
+        stop_codes = [code for code, label in enumerate(self.type_labels.astype(str)) if label in stop_types]
+        node_types = self.node_keys % len(self.type_labels)
+        visited = np.zeros(len(self.node_keys), dtype=bool)
+        visited[start] = True
+        frontier = np.array([start])
+        for _ in range(hops):
+            # Every neighbour of every frontier node, gathered without a Python loop
+            counts = self.indptr[frontier + 1] - self.indptr[frontier]
+            positions = np.repeat(self.indptr[frontier] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            neighbours = np.unique(self.indices[positions])
+            frontier = neighbours[~visited[neighbours]]
+            visited[frontier] = True
+            frontier = frontier[~np.isin(node_types[frontier], stop_codes)]
+            if not len(frontier):
+                break
+
+        visited[start] = False
+        found = np.flatnonzero(visited)
+        linked = {}
+        for type_code, id_code in zip(node_types[found], self.node_keys[found] // len(self.type_labels)):
+            linked.setdefault(self.type_labels[type_code].decode(), []).append(int(id_code))
+        return {resource_type: self.ids.ids(np.array(id_codes)) for resource_type, id_codes in sorted(linked.items())}
+
+
+def read_bytes_so_far():
+    """Returns the bytes this process has read through read calls, from /proc/self/io, or None"""
+    try:
+        with open('/proc/self/io', 'r') as inf:
+            for line in inf:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_kb():
+    """Returns the peak resident memory of this process so far in KB, or None where it can't be read"""
+    if getrusage is None:
+        return None
+    return getrusage(RUSAGE_SELF).ru_maxrss
+
+
+class CountingDecoder:
+    """Wraps a Decoder to count the lines and bytes it decodes into a Profiler"""
+    def __init__(self, decoder, profiler):
+        self.wrapped = decoder
+        self.profiler = profiler
+
+
+    def decode(self, line):
+        self.profiler.add(lines_decoded=1, bytes_decoded=len(line))
+        return self.wrapped.decode(line)
+
+
+class Profiler:
+    """Records wall time, bytes read, lines decoded and matched, and peak memory of a report
+
+    Phases and the files read inside them are timed with the phase() and file()
+    context managers. Patient takes a profiler and times its lookups with it, and
+    report() returns the measurements as a dict for JSON. Bytes read is what the file reads
+    returned; for memory-mapped searches, which don't show up there, it's the bytes searched.
+    """
+    COUNTERS = ['bytes_read', 'bytes_decoded', 'lines_decoded', 'lines_matched']
+
+    def __init__(self):
+        self.phases = {}
+        self.current_phase = None
+        self.current_file = None
+
+
+    @staticmethod
+    def new_counts():
+        return dict({counter: 0 for counter in Profiler.COUNTERS}, wall_seconds=0.0)
+
+
+    @contextmanager
+    def phase(self, name):
+        """Times a phase of the report; a phase run again adds to its earlier counts"""
+        counts = self.phases.setdefault(name, dict(self.new_counts(), files={}))
+        self.current_phase = counts
+        rchar = read_bytes_so_far()
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            counts['wall_seconds'] += time.perf_counter() - start
+            end_rchar = read_bytes_so_far()
+            if rchar is not None and end_rchar is not None:
+                counts['bytes_read'] += end_rchar - rchar
+            counts['peak_rss_kb'] = peak_rss_kb()
+            self.current_phase = None
+
+
+    @contextmanager
+    def file(self, path, searched_bytes=None):
+        """Times reading one file inside the current phase
+
+        searched_bytes is how much of a memory-mapped file was searched, which is
+        counted as read since mmap reads don't go through read calls.
+        """
+        counts = self.current_phase['files'].setdefault(path, self.new_counts())
+        self.current_file = counts
+        rchar = read_bytes_so_far()
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            counts['wall_seconds'] += time.perf_counter() - start
+            end_rchar = read_bytes_so_far()
+            read = end_rchar - rchar if rchar is not None and end_rchar is not None else 0
+            if searched_bytes is not None:
+                read += searched_bytes
+                self.current_phase['bytes_read'] += searched_bytes
+            counts['bytes_read'] += read
+            self.current_file = None
+
+
+    def add(self, **counters):
+        for counts in (self.current_phase, self.current_file):
+            if counts is not None:
+                for counter, n in counters.items():
+                    counts[counter] += n
+
+
+    def match(self):
+        self.add(lines_matched=1)
+
+
+    def decoder(self, decoder=None):
+        """Returns a decoder, DECODER by default, that counts what it decodes"""
+        return CountingDecoder(decoder or DECODER, self)
+
+
+    def report(self):
+        """Returns the phases with their files as a dict, times rounded to microseconds"""
+        def rounded(counts):
+            return {key: round(value, 6) if isinstance(value, float) else value for key, value in counts.items()}
+
+        return {'phases': {name: dict(rounded(counts), files={path: rounded(file_counts)
+                                                              for path, file_counts in counts['files'].items()})
+                           for name, counts in self.phases.items()},
+                'peak_rss_kb': peak_rss_kb()}
+
+
+    def save(self, path):
+        with open(path, 'w') as outf:
+            json.dump(self.report(), outf, indent=2)
+            outf.write("\n")
+
+
+def mapped_size(path):
+    """Returns the size of a file iter_candidates memory-maps, or None for a compressed one it reads"""
+    return os.path.getsize(path) if compression(path) is None else None
+
+
+class NullProfiler:
+    """Stands in for a Profiler when a report isn't profiled, doing nothing"""
+    @contextmanager
+    def phase(self, name):
+        yield None
+
+
+    @contextmanager
+    def file(self, path, searched_bytes=None):
+        yield None
+
+
+    def add(self, **counters):
+        pass
+
+
+    def match(self):
+        pass
+
+
+    def decoder(self, decoder=None):
+        return decoder
 
 
 class Patient:
     """Prints a report of FHIR resource references for a Patient by id or first and last name"""
-    def __init__(self, patient_id=None, first_name=None, last_name=None):
+    # Patients built without __init__, like the benchmark's, aren't profiled
+    profiler = NullProfiler()
+
+    def __init__(self, patient_id=None, first_name=None, last_name=None, index=None, references=None, workers=1,
+                 source='auto', profiler=None):
         self.first_name = first_name
         self.last_name = last_name
         self.patient_id = patient_id
+        self.workers = workers
+        self.source = source
+        self.entities = None
+        self.profiler = profiler or NullProfiler()
+
+        # Batch reports pass in references that were already counted
+        if references is not None:
+            self.references = references
+            return
+
+        # Answer from the reference index when one has been built, unless a scan is asked for
+        if index is None and source != 'scan':
+            with self.profiler.phase('load_index'):
+                index = ReferenceIndex.load()
+        self.index = index
         
         # lookup patient ID, or first and alst name
-        self.lookup_patient()
+        with self.profiler.phase('lookup_patient'):
+            self.lookup_patient()
+
+        if source == 'provenance' and os.path.exists(resource_file('Provenance.ndjson')):
+            with self.profiler.phase('count_provenance'):
+                if self.patient_id is None:
+                    self.references = {}
+                else:
+                    self.references = count_provenance({self.patient_id}).get(self.patient_id, {})
+            return
+
+        if source == 'edges':
+            with self.profiler.phase('edges'):
+                edges = EdgeStore.current()
+                if edges is not None:
+                    self.references = edges.patient_counts(self.patient_id)
+            if edges is not None:
+                return
+
+        if self.index is not None and source != 'scan':
+            self.references = dict(self.index.references.get(self.patient_id, {}))
+            return
         
         # lookup references
-        self.lookup_references()
+        with self.profiler.phase('lookup_references'):
+            self.lookup_references()
 
         # lookup references from ecnounters
-        self.lookup_encounters()
+        with self.profiler.phase('lookup_encounters'):
+            self.lookup_encounters()
         
     
     def load_patients(self):
-        """Loads Patient file"""
-        with open('./data/Patient.ndjson', 'r') as inf:
-            patients = ndjson.load(inf)
-        return patients
+        """Streams Patient file"""
+        return iter_ndjson(resource_file('Patient.ndjson'), self.profiler.decoder())
     
     
     def lookup_patient(self):
         """Look up Patients by ID or first and last name"""
+        if self.index is not None:
+            self.lookup_patient_index()
+            return
+
+        if self.patient_id == None and ((self.first_name == None) | (self.last_name == None)):
+            print('You need to provide a patient id, or first name and last name')
+            sys.exit(0)
+
         patients = self.load_patients()
-        if self.patient_id != None: 
-            for patient in patients:
-                if patient['id'] == self.patient_id:
-                    names = patient['name']        
-                    for name in names: # Not needed because [0] is always "official", but keeping it anyway as a check
-                        if name['use'] == 'official':
-                            self.first_name = name['given'][0]
-                            self.last_name = name['family']                            
-                            break
-                    break            
-            
+        with self.profiler.file(resource_file('Patient.ndjson')):
+            if self.patient_id != None: 
+                for patient in patients:
+                    if patient['id'] == self.patient_id:
+                        self.profiler.match()
+                        names = patient['name']        
+                        for name in names: # Not needed because [0] is always "official", but keeping it anyway as a check
+                            if name['use'] == 'official':
+                                self.first_name = name['given'][0]
+                                self.last_name = name['family']                            
+                                break
+                        break            
+                
+            else:
+                # lookup patient by name, in any of their name entries
+                for patient in patients:                
+                    if any((name.get('given', [None])[0] == self.first_name) & (name.get('family') == self.last_name)
+                           for name in patient['name']):
+                        self.profiler.match()
+                        self.patient_id = patient['id']
+                        break   
+    
+
+    def lookup_patient_index(self):
+        """Look up Patients by ID or first and last name in the reference index"""
+        if self.patient_id != None:
+            if self.patient_id in self.index.patients:
+                self.first_name, self.last_name = self.index.patients[self.patient_id]
         else:
             if (self.first_name == None) | (self.last_name == None):
                 print('You need to provide a patient id, or first name and last name')
                 sys.exit(0)
-            # lookup patient by name
-            for patient in patients:                
-                if(patient['name'][0]['given'][0] == self.first_name) & (patient['name'][0]['family'] == self.last_name):
-                    self.patient_id = patient['id']
-                    break   
-    
+            patient_ids = self.index.lookup_name(self.first_name, self.last_name)
+            if patient_ids:
+                self.patient_id = patient_ids[0]
+
 
     def load_resources(self):
         """Loads resource filepaths"""
-        return glob.glob('./data/*.ndjson')
+        return resource_files()
 
 
     def lookup_references(self):
         """Looks up references to a patient"""
+        if self.workers > 1:
+            references, _ = count_direct_references({self.patient_id}, workers=self.workers)
+            self.references = references.get(self.patient_id, {})
+            return
+
         resource_paths = self.load_resources()
         self.references = {}
+        if self.patient_id is None:
+            return
         
+        decoder = self.profiler.decoder(REFERENCE_DECODER)
         for resource_path in resource_paths:
-            with open(resource_path, 'r') as inf:
-                resources = ndjson.load(inf)
-            
-            for resource in resources:
-                if 'patient' in resource.keys():
-                    if resource['patient']['reference'].split('/')[1] == self.patient_id:
+            # Only decode the lines that mention the patient id
+            with self.profiler.file(resource_path, mapped_size(resource_path)):
+                for resource in iter_candidates(resource_path, self.patient_id.encode(), decoder=decoder):
+                    if patient_reference(resource) == self.patient_id:
+                        self.profiler.match()
                         resource_type = resource['resourceType']
                         if resource_type not in self.references.keys():
                             self.references[resource_type] = 1
                         else:
                             self.references[resource_type] += 1
-                elif 'subject' in resource.keys():
-                    if resource['subject']['reference'].split('/')[1] == self.patient_id:
-                        resource_type = resource['resourceType']
+
+
+    def lookup_encounters(self):
+        """Adds the practitioners, locations and organizations the patient's encounters reference"""
+        if self.patient_id is None:
+            return
+        encounter_path = resource_file('Encounter.ndjson')
+        encounter_file = iter_candidates(encounter_path, self.patient_id.encode(),
+                                         decoder=self.profiler.decoder(REFERENCE_DECODER))
+
+        with self.profiler.file(encounter_path, mapped_size(encounter_path)):
+            for encounter in encounter_file:
+                if encounter['subject']['reference'].split('/')[1] == self.patient_id:
+                    self.profiler.match()
+                    for resource_type, _ in encounter_reference_ids(encounter):
                         if resource_type not in self.references.keys():
                             self.references[resource_type] = 1
                         else:
                             self.references[resource_type] += 1
 
 
-    def lookup_encounters(self):
-        with open('./data/Encounter.ndjson', 'r') as inf:
-            encounter_file = ndjson.load(inf)
+    def lookup_entities(self, encounter_index=None):
+        """Looks up the distinct practitioners, locations and organizations in the patient's encounters"""
+        if encounter_index is None:
+            encounter_index = EncounterIndex.current()
+        self.entities = encounter_index.patient_entities(self.patient_id)
 
-        for i, encounter in enumerate(encounter_file):
-            #print(encounter)
 
-            patient_reference = patient = encounter['subject']['reference'].split('/')[1]
-            #print(patient_reference, patient_id)
-            if patient_reference == self.patient_id:
-                print("cool")
+    def report(self):
+        """Returns the report as a dict, with the references sorted by count"""
+        sorted_references = sorted(self.references.items(), key=lambda x: x[1], reverse=True)
+        report = {'patient_id': self.patient_id,
+                  'first_name': self.first_name,
+                  'last_name': self.last_name,
+                  'references': dict(sorted_references)}
+        if self.entities is not None:
+            report['entities'] = [{'resource_type': resource_type, 'id': resource_id, 'name': name, 'count': n}
+                                  for resource_type, resource_id, name, n in self.entities]
+        return report
 
-                print(encounter['resourceType'])
 
-                patient = encounter['subject']['reference']
+    def print_report(self, outf=sys.stdout):
+        report = self.report()
+        print("Patient Name:\t", report['first_name'], report['last_name'], file=outf)
+        print("Patient ID:\t", report['patient_id'], file=outf)
+        print("\n", file=outf)
+        print(f"{'RESOURCE_TYPE':25}{'COUNT':<25}", file=outf)
+        print(f"{'-'*30}", file=outf)
+        for i in report['references'].items():
+                print(f'{i[0]:25} {i[1]:<25}', file=outf)
+        if self.entities is not None:
+            print("\n", file=outf)
+            print(f"{'ENCOUNTER_ENTITY':25}{'NAME':30}{'ID':40}{'COUNT':<10}", file=outf)
+            print(f"{'-'*100}", file=outf)
+            for resource_type, resource_id, name, n in self.entities:
+                print(f'{resource_type:25}{name or "":30}{resource_id:40}{n:<10}', file=outf)
 
-                practitioner = encounter['participant'][0]['individual']['reference']        
-                if 'Practitioner' not in self.references.keys():
-                    self.references['Practitioner'] = 1
-                else:
-                    self.references['Practitioner'] += 1
 
-                location = encounter['location'][0]['location']['reference']
-                if 'Location' not in self.references.keys():
-                    self.references['Location'] = 1
-                else:
-                    self.references['Location'] += 1
 
-                organization = encounter['serviceProvider']['reference']
-                if 'Organization' not in self.references.keys():
-                    self.references['Organization'] = 1
-                else:
-                    self.references['Organization'] += 1
+def batch_references(patient_ids=None, index=None, workers=1, edges=None, source='auto'):
+    """Returns [(patient id, first name, last name, references)] for many patients
+
+    patient_ids is a list of ids, or None for every patient. Counts come from the
+    edge store or the index when given, otherwise the export is scanned once however
+    many patients are asked for. With source 'provenance' the counts come from the
+    Provenance targets instead.
+    """
+    if source == 'provenance':
+        wanted = None if patient_ids is None else set(patient_ids)
+        references = count_provenance(wanted)
+        if index is not None:
+            names = index.patients if patient_ids is not None else InternedDict(index.patients.items())
+        else:
+            names = InternedDict((patient['id'], official_name(patient))
+                                 for patient in iter_resources(resource_file('Patient.ndjson'), patient_ids=wanted))
+        if patient_ids is None:
+            patient_ids = list(names)
+        return [(patient_id, *names.get(patient_id, (None, None)), references.get(patient_id, {}))
+                for patient_id in patient_ids]
+
+    if edges is not None:
+        if index is not None:
+            names = index.patients
+        else:
+            names = InternedDict((patient['id'], official_name(patient))
+                                 for patient in iter_ndjson(resource_file('Patient.ndjson')))
+        if patient_ids is not None:
+            return [(patient_id, *names.get(patient_id, (None, None)), edges.patient_counts(patient_id))
+                    for patient_id in patient_ids]
+
+        edge_patient_ids, type_labels, counts = edges.population_counts()
+        references = {patient_id: {type_labels[j]: int(row[j]) for j in np.flatnonzero(row)}
+                      for patient_id, row in zip(edge_patient_ids, counts)}
+        return [(patient_id, *first_last, references.get(patient_id, {}))
+                for patient_id, first_last in names.items()]
+
+    if index is not None:
+        names, references = index.patients, index.references
+        if patient_ids is None:
+            # Read a saved index through once rather than a row per patient
+            names, references = dict(names.items()), dict(references.items())
+            patient_ids = list(names)
+        return [(patient_id, *names.get(patient_id, [None, None]), dict(references.get(patient_id, {})))
+                for patient_id in patient_ids]
+
+    wanted = None if patient_ids is None else set(patient_ids)
+    names = InternedDict()
+
+    def on_patient(patient):
+        if wanted is None or patient['id'] in wanted:
+            names[patient['id']] = official_name(patient)
+
+    references = count_references(wanted, on_patient=on_patient, workers=workers)
+    if patient_ids is None:
+        patient_ids = list(names)
+    return [(patient_id, *names.get(patient_id, (None, None)), references.get(patient_id, {}))
+            for patient_id in patient_ids]
+
+
+def write_batch(rows, output_format='text', outf=sys.stdout):
+    """Writes batch reports as one report per patient, or a combined csv/json table"""
+    if output_format == 'text':
+        for patient_id, first_name, last_name, references in rows:
+            Patient(patient_id, first_name, last_name, references=references).print_report(outf)
+            print("\n", file=outf)
 
+    elif output_format == 'csv':
+        resource_types = sorted({t for *_, references in rows for t in references})
+        writer = csv.writer(outf)
+        writer.writerow(['patient_id', 'first_name', 'last_name'] + resource_types)
+        for patient_id, first_name, last_name, references in rows:
+            writer.writerow([patient_id, first_name, last_name]
+                            + [references.get(t, 0) for t in resource_types])
 
-    def print_report(self):
-        print("Patient Name:\t", patient.first_name, patient.last_name)
-        print("Patient ID:\t", patient.patient_id)
-        print("\n")
-        print(f"{'RESOURCE_TYPE':25}{'COUNT':<25}")
-        print(f"{'-'*30}")
-        sorted_references = sorted(patient.references.items(), key=lambda x: x[1], reverse=True)
-        for i in sorted_references:
-                print(f'{i[0]:25} {i[1]:<25}')
+    elif output_format == 'json':
+        json.dump([Patient(patient_id, first_name, last_name, references=references).report()
+                   for patient_id, first_name, last_name, references in rows], outf, indent=2)
+        outf.write("\n")
 
+def load_name_index():
+    """Returns the reference index, or one with just the names from Patient.ndjson if it isn't built"""
+    index = ReferenceIndex.load()
+    if index is None:
+        index = ReferenceIndex()
+        for patient in iter_ndjson(resource_file('Patient.ndjson')):
+            index.add_patient(patient)
+    return index
 
 
+class ReportHandler(BaseHTTPRequestHandler):
+    """Answers GET /report?patient_id=... or /report?first_name=...&last_name=... with a JSON report"""
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/report':
+            status, body = 404, json.dumps({'error': 'Unknown path ' + url.path}).encode()
+        else:
+            query = parse_qs(url.query)
+            status, body = self.server.report(*(query.get(key, [None])[0]
+                                                for key in ('patient_id', 'first_name', 'last_name')))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReportServerMixin:
+    """Answers reports from an index loaded once, caching the encoded responses"""
+    daemon_threads = True
+
+    def setup_reports(self, index, cache_size):
+        self.index = index
+        self.report = lru_cache(maxsize=cache_size)(self.build_report)
+
+
+    def build_report(self, patient_id, first_name, last_name):
+        """Returns (HTTP status, JSON body) for a report query"""
+        if patient_id is None and (first_name is None or last_name is None):
+            return 400, json.dumps({'error': 'You need to provide a patient id, or first name and last name'}).encode()
+        patient = Patient(patient_id, first_name, last_name, index=self.index)
+        if patient.patient_id not in self.index.patients and patient.patient_id not in self.index.references:
+            return 404, json.dumps({'error': 'Patient not found'}).encode()
+        return 200, json.dumps(patient.report()).encode()
+
+
+class ReportServer(ReportServerMixin, ThreadingHTTPServer):
+    pass
+
+
+class UnixReportServer(ReportServerMixin, ThreadingMixIn, UnixStreamServer):
+    pass
+
+
+def serve(host='127.0.0.1', port=8765, socket_path=None, workers=1, cache_size=100000):
+    """Loads (or builds) the reference index once and answers report queries until interrupted"""
+    index = ReferenceIndex.load()
+    if index is None:
+        index = ReferenceIndex.build(workers=workers)
+        index.save()
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixReportServer(socket_path, ReportHandler)
+        print(f'Serving reports on unix socket {socket_path}')
+    else:
+        server = ReportServer((host, port), ReportHandler)
+        print(f'Serving reports on http://{host}:{port}/report')
+    server.setup_reports(index, cache_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 
 if __name__ == '__main__':    
     parser = argparse.ArgumentParser()    
+    parser.add_argument("command", nargs="?", default="report", choices=["report", "build-index", "build-edges", "build-graph",
+                                                                         "export-matrix", "find", "linked", "serve",
+                                                                         "verify-provenance"],
+                        help="Print a patient report, build the reference index, edge store or reference graph, "
+                             "export every patient's counts as a sparse matrix, "
+                             "list every resource linked to a patient within --hops references, "
+                             "find patient ids by name, serve reports over HTTP, "
+                             "or diff the Provenance counts against a full scan")
     parser.add_argument("--patient_id", help="A patient ID")
     parser.add_argument("--first_name", help="A patient's given name")
     parser.add_argument("--last_name", help="A patient's family name")
+    parser.add_argument("--match", default="exact", choices=["exact", "prefix", "fuzzy"],
+                        help="How find matches names: exactly, by case-insensitive prefix, or within --max_distance edits")
+    parser.add_argument("--max_distance", type=int, default=2, help="Edits allowed by --match fuzzy")
+    parser.add_argument("--patient-ids-file", help="Report on every patient ID in this file, one per line")
+    parser.add_argument("--all-patients", action="store_true", help="Report on every patient")
+    parser.add_argument("--format", default="text", choices=["text", "csv", "json"],
+                        help="Batch output: a report per patient, or a combined csv/json table")
+    parser.add_argument("--source", default="auto", choices=["auto", "scan", "edges", "provenance"],
+                        help="Count from the index when built (auto), by scanning the ndjson files, "
+                             "from the edge store, or from the Provenance targets (and their encounters)")
+    parser.add_argument("--entities", action="store_true",
+                        help="List the distinct practitioners, locations and organizations of the patient's encounters")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Have build-index start from scratch instead of indexing only what changed")
+    parser.add_argument("--hops", type=int, default=2, help="How many references linked follows from the patient")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to scan the resource files with")
+    parser.add_argument("--host", default="127.0.0.1", help="Address serve listens on")
+    parser.add_argument("--port", type=int, default=8765, help="Port serve listens on")
+    parser.add_argument("--socket", help="Unix socket path for serve to listen on instead of a port")
+    parser.add_argument("--decoder", default="auto", choices=["auto", "orjson", "simdjson", "json"],
+                        help="JSON library to decode the ndjson with; auto picks the fastest installed")
+    parser.add_argument("--profile", nargs="?", const="1up.profile.json",
+                        help="Write per-phase and per-file timings, bytes read, lines decoded and matched, "
+                             "and peak memory of the report to this JSON file (default 1up.profile.json)")
+    parser.add_argument("--output", default=MATRIX_PATH, help="Where export-matrix writes the npz matrix")
     args = parser.parse_args()    
+    use_decoder(args.decoder)
+
+    if args.command == "build-index":
+        index = ReferenceIndex.load(files_path=INDEX_FILES_PATH)
+        if index is None or args.rebuild:
+            index = ReferenceIndex()
+        index.refresh(workers=args.workers)
+        index.save()
+        sys.exit(0)
+
+    if args.command == "build-edges":
+        EdgeStore.build().save()
+        sys.exit(0)
+
+    if args.command == "build-graph":
+        ReferenceGraph.build().save()
+        sys.exit(0)
+
+    if args.command == "linked":
+        patient_id = args.patient_id or (load_name_index().lookup_name(args.first_name, args.last_name) or [None])[0]
+        graph = ReferenceGraph.load()
+        if patient_id is None or graph is None:
+            print('You need to provide a patient id, or first name and last name of a known patient, '
+                  'and to run build-graph first')
+            sys.exit(0)
+        linked = graph.linked(patient_id, args.hops)
+        if args.format == "json":
+            json.dump({'patient_id': patient_id, 'hops': args.hops, 'linked': linked}, sys.stdout, indent=2)
+            print()
+        else:
+            print("Patient ID:\t", patient_id)
+            print("\n")
+            print(f"{'RESOURCE_TYPE':25}{'COUNT':<25}")
+            print(f"{'-'*30}")
+            for resource_type, resource_ids in sorted(linked.items(), key=lambda x: len(x[1]), reverse=True):
+                print(f'{resource_type:25} {len(resource_ids):<25}')
+        sys.exit(0)
+
+    if args.command == "export-matrix":
+        export_matrix(args.output, workers=args.workers)
+        sys.exit(0)
+
+    if args.command == "serve":
+        serve(args.host, args.port, args.socket, args.workers)
+        sys.exit(0)
+
+    if args.command == "find":
+        index = load_name_index()
+        if args.match == "exact":
+            patient_ids = index.lookup_name(args.first_name, args.last_name)
+        elif args.match == "prefix":
+            patient_ids = index.name_index().prefix(args.first_name or '', args.last_name or '')
+        else:
+            patient_ids = [i for _, i in index.name_index().fuzzy(args.first_name or '', args.last_name or '',
+                                                                  args.max_distance)]
+        for patient_id in patient_ids:
+            print(patient_id, *index.patients.get(patient_id, []), sep="\t")
+        sys.exit(0)
+
+    patient_ids = None
+    if args.patient_ids_file:
+        with open(args.patient_ids_file, 'r') as inf:
+            patient_ids = [line.strip() for line in inf if line.strip()]
+
+    if args.command == "verify-provenance":
+        if patient_ids is None and not args.all_patients:
+            patient_ids = [args.patient_id or (load_name_index().lookup_name(args.first_name, args.last_name)
+                                               or [None])[0]]
+            if patient_ids == [None]:
+                print('You need to provide a patient id, or first name and last name of a known patient')
+                sys.exit(0)
+        differences = verify_provenance(patient_ids, args.workers)
+        print(f"{'PATIENT_ID':40}{'RESOURCE_TYPE':25}{'PROVENANCE':>12}{'SCAN':>12}")
+        for patient_id, resource_type, provenance_count, scan_count in differences:
+            print(f"{patient_id:40}{resource_type:25}{provenance_count:>12}{scan_count:>12}")
+        print(f"\n{len({d[0] for d in differences})} patients with differences")
+        sys.exit(0)
+
+    if args.patient_ids_file or args.all_patients:
+        profiler = Profiler() if args.profile else NullProfiler()
+        with profiler.phase('load_index'):
+            index = ReferenceIndex.load() if args.source != "scan" else None
+            edges = EdgeStore.current() if args.source == "edges" else None
+        with profiler.phase('batch_references'):
+            rows = batch_references(patient_ids, index, args.workers, edges, args.source)
+        with profiler.phase('write_batch'):
+            write_batch(rows, args.format)
+        if args.profile:
+            profiler.save(args.profile)
+        sys.exit(0)
 
-    patient = Patient(args.patient_id, args.first_name, args.last_name)
-    patient.print_report()
+    profiler = Profiler() if args.profile else None
+    patient = Patient(args.patient_id, args.first_name, args.last_name, workers=args.workers, source=args.source,
+                      profiler=profiler)
+    if args.entities:
+        with patient.profiler.phase('lookup_entities'):
+            patient.lookup_entities()
+    with patient.profiler.phase('print_report'):
+        patient.print_report()
+    if profiler is not None:
+        profiler.save(args.profile)
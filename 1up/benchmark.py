@@ -0,0 +1,200 @@
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import time
+
+from synthetic_fhir import Generator
+
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '1up.py')
+
+# Timed in this order at each scale; build_index has to run before report_index
+PHASES = ['lookup_patient', 'lookup_references', 'lookup_encounters', 'report', 'report_by_name',
+          'build_index', 'report_index']
+
+
+def load_1up():
+    """Imports 1up.py, whose name can't be imported with a plain import statement"""
+    spec = importlib.util.spec_from_file_location('oneup', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_io():
+    """Returns this process's (rchar, read_bytes) from /proc/self/io, or Nones where there isn't one
+
+    rchar counts bytes returned by read calls, read_bytes only what had to come from disk.
+    Neither counts pages touched through mmap.
+    """
+    try:
+        with open('/proc/self/io', 'r') as inf:
+            io = dict(line.split(': ') for line in inf.read().splitlines())
+        return int(io['rchar']), int(io['read_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def bare_patient(oneup, patient_id=None, first_name=None, last_name=None):
+    """Returns a Patient with nothing looked up, so each lookup can be timed on its own"""
+    patient = oneup.Patient.__new__(oneup.Patient)
+    patient.patient_id = patient_id
+    patient.first_name = first_name
+    patient.last_name = last_name
+    patient.index = None
+    patient.workers = 1
+    patient.source = 'scan'
+    patient.entities = None
+    patient.references = {}
+    return patient
+
+
+def run_phase(oneup, phase, patient_id, first_name, last_name):
+    if phase == 'lookup_patient':
+        bare_patient(oneup, patient_id).lookup_patient()
+    elif phase == 'lookup_references':
+        bare_patient(oneup, patient_id).lookup_references()
+    elif phase == 'lookup_encounters':
+        bare_patient(oneup, patient_id).lookup_encounters()
+    elif phase == 'report':
+        oneup.Patient(patient_id, source='scan').report()
+    elif phase == 'report_by_name':
+        oneup.Patient(first_name=first_name, last_name=last_name, source='scan').report()
+    elif phase == 'build_index':
+        oneup.ReferenceIndex.build().save()
+    elif phase == 'report_index':
+        oneup.Patient(patient_id).report()
+
+
+def measure(root, phase, patient_id, first_name, last_name, results):
+    """Runs one phase in this (fresh) process and puts its wall time, peak RSS and bytes read on results"""
+    os.chdir(root)
+    oneup = load_1up()
+    rchar, read_bytes = read_io()
+    start = time.perf_counter()
+    run_phase(oneup, phase, patient_id, first_name, last_name)
+    wall = time.perf_counter() - start
+    end_rchar, end_read_bytes = read_io()
+    results.put({'wall_seconds': round(wall, 4),
+                 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 'rchar': None if rchar is None else end_rchar - rchar,
+                 'read_bytes': None if read_bytes is None else end_read_bytes - read_bytes})
+
+
+def dataset_stats(data_dir):
+    """Returns the number of lines and bytes in the ndjson files of data_dir"""
+    lines = 0
+    size = 0
+    for name in os.listdir(data_dir):
+        if name.endswith('.ndjson'):
+            path = os.path.join(data_dir, name)
+            size += os.path.getsize(path)
+            with open(path, 'rb') as inf:
+                lines += sum(chunk.count(b'\n') for chunk in iter(lambda: inf.read(1 << 20), b''))
+    return lines, size
+
+
+def target_patient(data_dir, oneup):
+    """Returns the id and official name of the patient halfway down Patient.ndjson"""
+    path = os.path.join(data_dir, 'Patient.ndjson')
+    with open(path, 'rb') as inf:
+        total = sum(1 for _ in inf)
+    for n, patient in enumerate(oneup.iter_ndjson(path)):
+        if n == total // 2:
+            return (patient['id'], *oneup.official_name(patient))
+
+
+def wait_for_result(process, results, phase):
+    """Returns the measurement process's result, or raises if it exits without one"""
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                process.join()
+                raise RuntimeError(f'{phase} failed in its measurement process (exit code {process.exitcode})')
+
+
+def benchmark_scale(root, patients, resources_per_patient, seed, repeat):
+    """Generates (or reuses) the export for one scale and times every phase against it"""
+    data_dir = os.path.join(root, 'data')
+    if not os.path.exists(os.path.join(data_dir, 'Patient.ndjson')):
+        print(f'Generating {patients} patients in {data_dir}')
+        Generator(data_dir, seed).generate(patients, resources_per_patient)
+    for name in os.listdir(data_dir):
+        if name.startswith('1up.'):
+            os.remove(os.path.join(data_dir, name))
+
+    oneup = load_1up()
+    lines, size = dataset_stats(data_dir)
+    patient_id, first_name, last_name = target_patient(data_dir, oneup)
+
+    # Each measurement gets its own spawned process so peak RSS and bytes read are its own
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    phases = {}
+    for phase in PHASES:
+        runs = []
+        for _ in range(repeat):
+            process = context.Process(target=measure, args=(root, phase, patient_id, first_name, last_name, results))
+            process.start()
+            runs.append(wait_for_result(process, results, phase))
+            process.join()
+        best = min(runs, key=lambda run: run['wall_seconds'])
+        phases[phase] = best
+        print(f'{patients:>10} patients  {phase:20}{best["wall_seconds"]:>10.3f}s{best["peak_rss_kb"]:>12} KB')
+
+    return {'patients': patients,
+            'resources_per_patient': resources_per_patient,
+            'lines': lines,
+            'bytes': size,
+            'phases': phases}
+
+
+def compare(results, baseline, threshold):
+    """Prints the phases whose wall time grew by more than threshold over the baseline run"""
+    previous = {scale['patients']: scale['phases'] for scale in baseline['scales']}
+    for scale in results['scales']:
+        for phase, result in scale['phases'].items():
+            before = previous.get(scale['patients'], {}).get(phase)
+            if before is None or before['wall_seconds'] == 0:
+                continue
+            ratio = result['wall_seconds'] / before['wall_seconds']
+            if ratio > 1 + threshold:
+                print(f'REGRESSION {scale["patients"]:>10} patients  {phase:20}'
+                      f'{before["wall_seconds"]:.3f}s -> {result["wall_seconds"]:.3f}s ({ratio:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time 1up.py lookups and reports against synthetic exports of increasing size")
+    parser.add_argument("--scales", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="Patient counts to benchmark")
+    parser.add_argument("--resources_per_patient", type=int, default=100,
+                        help="Average number of resources referencing each patient")
+    parser.add_argument("--root", default="./benchmark_data",
+                        help="Directory the exports are generated in, one subdirectory per scale; reused between runs")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the generator")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per phase; the fastest is kept")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="An earlier results file to flag regressions against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Fractional slowdown over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    results = {'script': SCRIPT_PATH,
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'scales': []}
+    for patients in args.scales:
+        root = os.path.abspath(os.path.join(args.root, f'{patients}x{args.resources_per_patient}'))
+        results['scales'].append(benchmark_scale(root, patients, args.resources_per_patient, args.seed, args.repeat))
+
+    with open(args.output, 'w') as outf:
+        json.dump(results, outf, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as inf:
+            compare(results, json.load(inf), args.threshold)
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import random
+import uuid
+
+
+# Share of each patient's resources that are of each type, roughly like a Synthea export
+RESOURCE_WEIGHTS = {'Observation': 0.50,
+                    'Encounter': 0.10,
+                    'Condition': 0.08,
+                    'Procedure': 0.08,
+                    'MedicationRequest': 0.08,
+                    'DiagnosticReport': 0.06,
+                    'Immunization': 0.04,
+                    'AllergyIntolerance': 0.02,
+                    'CarePlan': 0.02,
+                    'Claim': 0.02}
+
+# These reference their patient through 'patient' instead of 'subject'
+PATIENT_KEY_TYPES = ['AllergyIntolerance', 'Claim', 'Immunization']
+
+# Shared resources that encounters and medication requests point at
+SHARED_COUNTS = {'Practitioner': 50, 'Location': 20, 'Organization': 10, 'Medication': 100}
+
+GIVEN_NAMES = ['Rosamond', 'Ezra', 'Mabel', 'Otis', 'Hazel', 'Silas', 'Ida', 'Jasper', 'Wren', 'Abel']
+FAMILY_NAMES = ['Lynch', 'Okafor', 'Nguyen', 'Schmidt', 'Alvarez', 'Kowalski', 'Haddad', 'Tanaka', 'Moreau', 'Reyes']
+
+
+class Generator:
+    """Writes a synthetic FHIR bulk export, one ndjson file per resource type
+
+    Patients are written one at a time with every resource that references them, so
+    memory stays flat whatever the size of the export. The same seed always
+    writes the same export.
+    """
+    def __init__(self, data_dir='./data', seed=0):
+        self.data_dir = data_dir
+        self.random = random.Random(seed)
+        self.files = {}
+        self.lines = 0
+        self.shared = {resource_type: [self.new_id() for _ in range(n)]
+                       for resource_type, n in SHARED_COUNTS.items()}
+
+
+    def new_id(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+
+    def write(self, resource):
+        resource_type = resource['resourceType']
+        if resource_type not in self.files:
+            self.files[resource_type] = open(os.path.join(self.data_dir, resource_type + '.ndjson'), 'w')
+        self.files[resource_type].write(json.dumps(resource) + '\n')
+        self.lines += 1
+
+
+    def pick(self, resource_type):
+        return f'{resource_type}/{self.random.choice(self.shared[resource_type])}'
+
+
+    def write_shared(self):
+        """Writes the practitioners, locations, organizations and medications"""
+        for i, resource_id in enumerate(self.shared['Practitioner']):
+            self.write({'resourceType': 'Practitioner', 'id': resource_id,
+                        'name': [{'prefix': ['Dr.'], 'given': [self.random.choice(GIVEN_NAMES)],
+                                  'family': self.random.choice(FAMILY_NAMES) + str(i)}]})
+        for i, resource_id in enumerate(self.shared['Location']):
+            self.write({'resourceType': 'Location', 'id': resource_id, 'name': f'Clinic {i}'})
+        for i, resource_id in enumerate(self.shared['Organization']):
+            self.write({'resourceType': 'Organization', 'id': resource_id, 'name': f'Health System {i}'})
+        for i, resource_id in enumerate(self.shared['Medication']):
+            self.write({'resourceType': 'Medication', 'id': resource_id,
+                        'code': {'text': f'Medication {i}'}})
+
+
+    def write_patient(self, n, resources_per_patient):
+        """Writes a patient, their resources, and a Provenance listing them all"""
+        patient_id = self.new_id()
+        given = self.random.choice(GIVEN_NAMES) + str(n)
+        family = self.random.choice(FAMILY_NAMES) + str(n % 1000)
+        names = [{'use': 'official', 'given': [given], 'family': family}]
+        if self.random.random() < 0.1:
+            names.append({'use': 'maiden', 'given': [given], 'family': self.random.choice(FAMILY_NAMES)})
+        self.write({'resourceType': 'Patient', 'id': patient_id, 'name': names})
+
+        patient = {'reference': f'Patient/{patient_id}'}
+        targets = [patient]
+        encounters = []
+        observations = []
+        for resource_type, weight in RESOURCE_WEIGHTS.items():
+            for _ in range(int(resources_per_patient * weight + self.random.random())):
+                resource_id = self.new_id()
+                resource = {'resourceType': resource_type, 'id': resource_id}
+                resource['patient' if resource_type in PATIENT_KEY_TYPES else 'subject'] = patient
+
+                if resource_type == 'Encounter':
+                    resource['participant'] = [{'individual': {'reference': self.pick('Practitioner')}}
+                                               for _ in range(self.random.randint(1, 2))]
+                    resource['location'] = [{'location': {'reference': self.pick('Location')}}]
+                    resource['serviceProvider'] = {'reference': self.pick('Organization')}
+                    encounters.append(resource_id)
+                elif encounters:
+                    resource['encounter'] = {'reference': f'Encounter/{self.random.choice(encounters)}'}
+
+                if resource_type == 'Observation':
+                    observations.append(resource_id)
+                elif resource_type == 'DiagnosticReport' and observations:
+                    resource['result'] = [{'reference': f'Observation/{observation}'}
+                                          for observation in self.random.sample(observations,
+                                                                                min(3, len(observations)))]
+                elif resource_type == 'MedicationRequest':
+                    resource['medicationReference'] = {'reference': self.pick('Medication')}
+
+                self.write(resource)
+                targets.append({'reference': f'{resource_type}/{resource_id}'})
+
+        self.write({'resourceType': 'Provenance', 'id': self.new_id(), 'target': targets})
+
+
+    def generate(self, patients, resources_per_patient):
+        """Writes the whole export and returns the number of lines written"""
+        os.makedirs(self.data_dir, exist_ok=True)
+        try:
+            self.write_shared()
+            for n in range(patients):
+                self.write_patient(n, resources_per_patient)
+        finally:
+            for outf in self.files.values():
+                outf.close()
+        return self.lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic FHIR bulk export for testing and benchmarking 1up.py")
+    parser.add_argument("--patients", type=int, default=1000, help="Number of patients")
+    parser.add_argument("--resources_per_patient", type=int, default=100,
+                        help="Average number of resources referencing each patient")
+    parser.add_argument("--data_dir", default="./data", help="Directory to write the ndjson files to")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    lines = Generator(args.data_dir, args.seed).generate(args.patients, args.resources_per_patient)
+    print(f'Wrote {lines} resources to {args.data_dir}')
@@ -1,9 +1,15 @@
 #!/usr/bin/python
+import concurrent.futures
 import configparser
 import copy
 import csv
 import glob
+import hashlib
+import io
+import json
+import math
 import os
+import sqlite3
 import subprocess
 import sys
 import time
@@ -15,6 +21,30 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 
 
+# Sample file headers are read by this many threads
+PARSE_THREADS = 16
+
+# How much of a sample file is searched for its header, and in what size reads
+HEADER_BYTES = 1 << 20
+HEADER_CHUNK = 1 << 16
+
+# Parsed sample headers are kept here between runs
+SAMPLE_CACHE = '.clonality_cache.sqlite'
+
+# Hashes of the inputs of each stats, plot and masterfile node that's up to date
+PIPELINE_STATE = '.clonality_state.json'
+
+# Where error_log writes, a --dry-run sets it to None so messages go to stderr instead
+ERROR_LOG = 'error.log'
+
+# The config options that change how plot_graph draws a figure
+PLOT_OPTIONS = ['config_correction', 'config_title', 'config_order', 'config_xrotation',
+                'config_boxplots', 'config_boxcolors', 'config_boxpalette',
+                'config_stripplots', 'config_dotcolors', 'config_dotpalette', 'config_jitter',
+                'config_meanbars', 'config_errorbars', 'config_logscale', 'config_annotation',
+                'config_dpi', 'config_width', 'config_height']
+
+
 def parse_arbitrary(metadata, arbitrary_list):
     """Rewrite list elements into dictionaries"""
     # arbitrary_list becomes a list of dictionaries in this function
@@ -62,10 +92,13 @@ def clean_data(parsed_data, fname_var):
     return parsed_data
 
 
-def prep_files(metadatafilename='metadata.tsv', configfilename='config.cfg'):
-    """Return parsed and cleaned data/metadata/config data"""
-    # Parse command line or search locally
-    args = sys.argv
+def prep_files(metadatafilename='metadata.tsv', configfilename='config.cfg', dry_run=False):
+    """Return parsed and cleaned data/metadata/config data
+
+    On a dry run a missing config isn't created, the config file returned is None and the defaults are used.
+    """
+    # Parse command line or search locally, the --force and --dry-run flags aren't files
+    args = [arg for arg in sys.argv if not arg.startswith('--')]
     if len(args) == 1:
         args = os.listdir('.')
     if metadatafilename is None:
@@ -97,10 +130,14 @@ def prep_files(metadatafilename='metadata.tsv', configfilename='config.cfg'):
             error_log('Found ' + configfilename + ' in the local directory.')
             cfg_file = configfilename
         except AssertionError:
-            error_log("Config file not found. Creating config.cfg with default options...")
-            # make a new default config
-            createConfig()
-            cfg_file = 'config.cfg'
+            if dry_run:
+                error_log("Config file not found. Using the default options...")
+                cfg_file = None
+            else:
+                error_log("Config file not found. Creating config.cfg with default options...")
+                # make a new default config
+                createConfig()
+                cfg_file = 'config.cfg'
 
     # Sort arguments into sample files
     samples_list = []
@@ -230,10 +267,13 @@ def prep_meta(meta_file_to_prep='metadata.tsv'):
 
 
 def config_checker(cfg_file):
-    """Return dictionary of config options"""
+    """Return dictionary of config options, the defaults if cfg_file is None"""
     config_dict = {}
     config = configparser.RawConfigParser(allow_no_value=True)
-    config.read(cfg_file)
+    if cfg_file is None:
+        config.read_string(createConfig(None))
+    else:
+        config.read(cfg_file)
 
     try:
         config_correction = config.get('statistics', 'Correction')
@@ -272,6 +312,17 @@ def config_checker(cfg_file):
                                                 'The defualt "False" was used. '
                                                 'Verbose options are True or False.')
 
+    try:
+        # Older config files don't have an engine, so they keep using R
+        config_engine = config.get('statistics', 'Engine', fallback='R')
+        assert config_engine.lower() in ('r', 'rworker', 'python')
+        config_dict['config_engine'] = config_engine.lower()
+    except AssertionError:
+        config_dict['config_engine'] = 'r'
+        error_log(
+            '"' + config_engine + '"' + ' is not a valid option for Engine. '
+                                        'The defualt "R" was used. Engine options are R, Rworker or Python.')
+
     try:
         config_error_log = config.get('output', 'Error log')
         assert "true" in config_error_log.lower() or "false" in config_error_log.lower()
@@ -294,6 +345,20 @@ def config_checker(cfg_file):
             '"' + config_overwrite + '"' + ' is not a valid option for Overwrite. '
                                            'The defualt "True" was used. Options are True or False.')
 
+    try:
+        # Older config files don't have this option, so they render one figure at a time
+        config_plot_workers = config.get('output', 'Plot workers', fallback='1')
+        config_plot_workers = int(config_plot_workers)
+        assert config_plot_workers >= 0
+        # 0 uses every core
+        config_dict['config_plot_workers'] = config_plot_workers or os.cpu_count()
+    except (AssertionError, ValueError):
+        config_dict['config_plot_workers'] = 1
+        error_log(
+            '"' + str(config_plot_workers) + '"' + ' is not a valid option for Plot workers. '
+                                                   'The defualt "1" was used. '
+                                                   'Plot workers options are 0 (every core) or a positive integer.')
+
     # Can be blank, doesn't matter, doesn't need to be checked,... maybe
     config_title = config.get('graph_options', 'Title')
     config_dict['config_title'] = config_title
@@ -491,9 +556,11 @@ def config_checker(cfg_file):
 def createConfig(configFile='config.cfg',
                  correction=None,
                  verbose=False,
+                 engine='R',
                  masterfile=True,
                  error_log=True,
                  overwrite=True,
+                 plot_workers=1,
                  title='ImmunoSEQ Analyzer',
                  custom_order=False,
                  xrotation=0,
@@ -511,17 +578,18 @@ def createConfig(configFile='config.cfg',
                  dpi=600,
                  width=8,
                  height=5):
-    """Create a default configuration file"""
-    # Write to file
-    with open(configFile, 'w') as cfg:
+    """Return the text of a default configuration file, writing it to configFile unless that's None"""
+    with io.StringIO() as cfg:
         cfg.write('[statistics]\n')
         cfg.write('Correction = ' + str(correction) + '\n')
-        cfg.write('Verbose = ' + str(verbose) + "\n\n")
+        cfg.write('Verbose = ' + str(verbose) + "\n")
+        cfg.write('Engine = ' + str(engine) + "\n\n")
 
         cfg.write('[output]\n')
         cfg.write('Masterfile = ' + str(masterfile) + "\n")
         cfg.write('Error log = ' + str(error_log) + "\n")
-        cfg.write('Overwrite = ' + str(overwrite) + "\n\n")
+        cfg.write('Overwrite = ' + str(overwrite) + "\n")
+        cfg.write('Plot workers = ' + str(plot_workers) + "\n\n")
 
         cfg.write('[graph_options]\n')
         cfg.write('Title = ' + title + "\n")
@@ -545,10 +613,88 @@ def createConfig(configFile='config.cfg',
         cfg.write('DPI = ' + str(dpi) + "\n")
         cfg.write('Width = ' + str(width) + "\n")
         cfg.write('Height = ' + str(height) + "\n")
+        text = cfg.getvalue()
+
+    # Write to file
+    if configFile is not None:
+        with open(configFile, 'w') as outfile:
+            outfile.write(text)
+    return text
+
+
+class SampleCache:
+    """Parsed sample headers from earlier runs, in SQLite
+
+    Rows are keyed on the sample's path, size, mtime and the hash of the header lines
+    parse_header read. A sample whose path, size and mtime still match its row is taken
+    from the cache without opening it. One whose size or mtime changed has its header
+    hashed again and is only reparsed if the hash differs. A read only cache is never
+    written to, and the file must already exist.
+    """
+    def __init__(self, path=SAMPLE_CACHE, read_only=False):
+        self.read_only = read_only
+        if read_only:
+            self.connection = sqlite3.connect('file:' + os.path.abspath(path) + '?mode=ro', uri=True)
+        else:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS samples ('
+                                    'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT, '
+                                    'clonality TEXT, tcell TEXT, diagnostics TEXT)')
+
+
+    def lookup(self, samples):
+        """Return parse_header's results for the samples that haven't changed since they were cached"""
+        headers = {}
+        touched = []
+        for sample in samples:
+            try:
+                stat = os.stat(sample)
+            except OSError:
+                continue
+            path = os.path.abspath(sample)
+            row = self.connection.execute('SELECT size, mtime_ns, clonality, tcell, diagnostics, hash FROM samples '
+                                          'WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                continue
+            size, mtime_ns, clonality, tcell, diagnostics, digest = row
+            if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                # Touched or appended to, the values only change if the header did
+                try:
+                    if read_header(sample)[1] != digest:
+                        continue
+                except OSError:
+                    continue
+                touched.append((stat.st_size, stat.st_mtime_ns, path))
+            headers[sample] = (clonality, tcell, json.loads(diagnostics), digest)
+
+        if touched and not self.read_only:
+            with self.connection:
+                self.connection.executemany('UPDATE samples SET size = ?, mtime_ns = ? WHERE path = ?', touched)
+        return headers
+
+
+    def store(self, headers):
+        """Save parse_header's results for the given samples"""
+        if self.read_only:
+            return
+        rows = []
+        for sample, (clonality, tcell, diagnostics, digest) in headers.items():
+            stat = os.stat(sample)
+            rows.append((os.path.abspath(sample), stat.st_size, stat.st_mtime_ns, digest,
+                         clonality, tcell, json.dumps(diagnostics)))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
 
+    def close(self):
+        self.connection.close()
 
-def get_data(samples_list, metadata_dict):
-    """Return values from sample files"""
+
+def get_data(samples_list, metadata_dict, cache_path=SAMPLE_CACHE, read_only=False):
+    """Return values from sample files, using the sample cache unless cache_path is None
+
+    A read only cache is only used if it already exists, and newly parsed samples aren't added to it.
+    """
     # Initialize dictionaries to return
     parsed_clonality = dict()
     parsed_tcell = dict()
@@ -570,12 +716,31 @@ def get_data(samples_list, metadata_dict):
         reproduction_clonality[(group, sample)] = []
         reproduction_tcell[(group, sample)] = []
 
+    # Samples in the metadata that haven't changed since they were cached don't need to be read
+    metadata_samples = [sample for sample in samples_list if sample in meta_samples]
+    if cache_path is not None and (not read_only or os.path.exists(cache_path)):
+        cache = SampleCache(cache_path, read_only)
+    else:
+        cache = None
+    headers = cache.lookup(metadata_samples) if cache is not None else {}
+
+    # Parse the headers of the rest in parallel, since it's mostly waiting on reads
+    unparsed = [sample for sample in metadata_samples if sample not in headers]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PARSE_THREADS) as executor:
+        parsed = dict(zip(unparsed, executor.map(parse_header, unparsed)))
+    if cache is not None:
+        cache.store(parsed)
+        cache.close()
+    headers.update(parsed)
+
     # Iterate through the sample files from sysarg
     for sample in samples_list:
         # Check to make sure it's in metadata before doing anything
         if sample in meta_samples:
-            # Parse the desired value out of each sample file
-            clonality, tcell = parse_file(sample)
+            # The desired values out of each sample file, logging the diagnostics in sample order
+            clonality, tcell, diagnostics, digest = headers[sample]
+            for diagnostic in diagnostics:
+                error_log(diagnostic)
             # Convert non-numbers and out of range numbers to None
             if type(clonality) is str:
                 clonality = float(clonality)
@@ -616,38 +781,61 @@ def get_data(samples_list, metadata_dict):
     return parsed_clonality, parsed_tcell, reproduction_clonality, reproduction_tcell
 
 
-def parse_file(sample):
-    """Return Clonality and %Tcell values from individual sample files"""
-    clonality, tcell = None, None
-    samplefile = sample
-    with open(sample, 'r') as sample:
-        for line in sample:
-            if line.startswith('#clonality'):
-                # Clean up the value and put it in group/sample dictionary
-                clonality = line.strip().split('=')[-1]
-
-                # Discard any clonality values that are not between 0 and 1
-                if 'NA' in clonality or clonality is '':
-                    error_log(samplefile + ' -  Clonality Value: " ' + clonality + ' "')
-                    clonality = None
-
-                elif float(clonality) < 0 or float(clonality) > 1:
-                    error_log(samplefile + ' -  Clonality Value: "' + clonality + '" out of range')
-                    clonality = None
-
-            elif line.startswith('#percentReceptor'):
-                # Clean up the value and put it in group/sample dictionary
-                tcell = line.strip().split('=')[-1]
-                if 'NA' in tcell or tcell == '':
-                    error_log(samplefile + ' -  Tcell Value: " ' + tcell + ' "')
-                    tcell = None
-                elif float(tcell) < 0 or float(tcell) > 1:
-                    error_log(samplefile + ' -  Tcell Value: "' + tcell + '" out of range')
-                    tcell = None
-
+def read_header(sample):
+    """Return the #clonality and #percentReceptor lines from the start of a sample file, and a hash of those lines"""
+    header = []
+    digest = hashlib.sha256()
+    with open(sample, 'rb') as infile:
+        partial = b''
+        # Only the header is read, a file without #percentReceptor stops at HEADER_BYTES
+        for _ in range(HEADER_BYTES // HEADER_CHUNK):
+            chunk = infile.read(HEADER_CHUNK)
+            lines = (partial + chunk).split(b'\n')
+            # Keep a partial last line for the next chunk unless the file ended
+            partial = lines.pop() if chunk else b''
+            for line in lines:
+                if line.startswith(b'#clonality'):
+                    digest.update(line + b'\n')
+                    header.append(line.decode(errors='replace'))
+                elif line.startswith(b'#percentReceptor'):
+                    digest.update(line + b'\n')
+                    header.append(line.decode(errors='replace'))
+                    return header, digest.hexdigest()
+            if not chunk:
                 break
+    return header, digest.hexdigest()
 
-    return clonality, tcell
+
+def parse_header(sample):
+    """Return Clonality and %Tcell values, any diagnostics and the header hash from individual sample files"""
+    clonality, tcell = None, None
+    diagnostics = []
+    header, digest = read_header(sample)
+    for line in header:
+        if line.startswith('#clonality'):
+            # Clean up the value and put it in group/sample dictionary
+            clonality = line.strip().split('=')[-1]
+
+            # Discard any clonality values that are not between 0 and 1
+            if 'NA' in clonality or clonality == '':
+                diagnostics.append(sample + ' -  Clonality Value: " ' + clonality + ' "')
+                clonality = None
+
+            elif float(clonality) < 0 or float(clonality) > 1:
+                diagnostics.append(sample + ' -  Clonality Value: "' + clonality + '" out of range')
+                clonality = None
+
+        elif line.startswith('#percentReceptor'):
+            # Clean up the value and put it in group/sample dictionary
+            tcell = line.strip().split('=')[-1]
+            if 'NA' in tcell or tcell == '':
+                diagnostics.append(sample + ' -  Tcell Value: " ' + tcell + ' "')
+                tcell = None
+            elif float(tcell) < 0 or float(tcell) > 1:
+                diagnostics.append(sample + ' -  Tcell Value: "' + tcell + '" out of range')
+                tcell = None
+
+    return clonality, tcell, diagnostics, digest
 
 
 def parse_SEM(file_name_var):
@@ -712,68 +900,328 @@ def parse_SEM(file_name_var):
     return means, SEM, sd
 
 
-def do_stats(parsed_data, file_name_var, config_dict, reproduction_data):
-    """Call R script to perform stats"""
-    # just a note: file_name_var tells R if the data is clonality or %Tcell
-    correction = config_dict['config_correction']
-    verbose = config_dict['config_output_verbose']
-
+def stats_inputs(parsed_data, file_name_var, reproduction_data):
+    """Return (data type, group values, reproducibility rows) for each metric in parsed_data"""
+    metrics = []
     # In this case the data will come as a single dictionary
     if 'clonality' in file_name_var or 'tcell' in file_name_var:
+        values = [(group, value) for group, values in parsed_data.items() for value in values]
+        repro = [(sample, group, value) for (group, sample), value in reproduction_data.items()]
+        metrics.append((file_name_var, values, repro))
 
-        # Write dict to tsv
-        with open("pre_stats.tsv", 'w', newline='') as outfile:
-            writer = csv.writer(outfile, delimiter='\t')
-            writer.writerow(("Group", "Value", file_name_var, correction, verbose))
-            # Add clonality or %T Cells data points
-            for key, values in parsed_data.items():
-                for value in values:
-                    writer.writerow((key, value))
-
-        with open("pre_repro.tsv", 'w', newline='') as outfile2:
-            writer = csv.writer(outfile2, delimiter='\t')
-            writer.writerow(("Sample", "Group", "Value"))
-            # add the reproducable data
-            for (group, sample), value in reproduction_data.items():
-                writer.writerow((sample, group, value))
-
-        # Run R script
-        cmd = 'Rscript'
-        script = 'clonality.R'
-        subprocess.call([cmd, script])
-
-    # In this case, data will be as a list of dicitonaries
+    # In this case, data will be as a list of dicitonaries, one metric each
     elif 'arb' in file_name_var:
-        # loop through the list of dictionaries
         for i, arbdict in enumerate(parsed_data):
+            values = [(group, value) for (group, sample), value in arbdict.items()]
+            repro = [(sample, group, value) for (group, sample), value in reproduction_data[i].items()]
+            metrics.append((file_name_var + str(i + 1), values, repro))
+
+    return metrics
 
-            with open('pre_stats.tsv', 'w', newline='') as outfile:
-                writer = csv.writer(outfile, delimiter='\t')
-                writer.writerow(("Group", "Value", file_name_var + str(i + 1), correction, verbose))
 
-                # Loop through the individual dictionary
-                for (group, sample), value in arbdict.items():
-                    writer.writerow((group, value))
+def pre_stats_rows(data_type, values, repro, correction, verbose):
+    """Return the rows of pre_stats.tsv and pre_repro.tsv that clonality.R reads"""
+    # The stats header also tells R the data type, correction and verbosity
+    stats_rows = [("Group", "Value", data_type, correction, verbose)]
+    # Add clonality, %T Cells or arbitrary data points
+    stats_rows.extend((group, value) for group, value in values)
 
-            with open('pre_repro.tsv', 'w', newline='') as outfile2:
-                writer = csv.writer(outfile2, delimiter='\t')
-                writer.writerow(("Sample", "Group", "Value"))
-                # Loop through the list of arb dictonaries
-                for (group, sample), value in reproduction_data[i].items():
-                    writer.writerow((sample, group, value))
+    repro_rows = [("Sample", "Group", "Value")]
+    # add the reproducable data
+    repro_rows.extend((sample, group, value) for sample, group, value in repro)
+    return stats_rows, repro_rows
+
+
+class RWorker:
+    """One Rscript process that runs clonality.R's stats for every metric in a run"""
+    def __init__(self, script='clonality.R'):
+        self.process = subprocess.Popen(['Rscript', script, '--worker'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+
+
+    def run(self, data_type, stats_rows, repro_rows):
+        """Return the test results for one metric, after R appends them to its post_stats file"""
+        tables = []
+        for rows in (stats_rows, repro_rows):
+            table = io.StringIO()
+            csv.writer(table, delimiter='\t', lineterminator='\n').writerows(rows)
+            tables.append(table.getvalue())
+
+        # A request line with the number of lines in each table, then the tables
+        try:
+            self.process.stdin.write(data_type + '\t' + str(len(stats_rows)) + '\t' + str(len(repro_rows)) + '\n')
+            self.process.stdin.write(tables[0] + tables[1])
+            self.process.stdin.flush()
+            reply = self.process.stdout.readline()
+            status, count = reply.rstrip('\n').split('\t')
+        except (BrokenPipeError, ValueError):
+            error_log('The R worker stopped before returning stats for ' + data_type + '.')
+            return None
+        lines = [self.process.stdout.readline().rstrip('\n') for _ in range(int(count))]
+
+        if status != 'ok':
+            error_log('R could not do stats for ' + data_type + ': ' + ' '.join(lines))
+            return None
+        tests = []
+        for line in lines:
+            test, correction, comparison, pvalue, significant = line.split('\t')
+            tests.append((test, correction, comparison, float('nan') if pvalue == 'NA' else float(pvalue),
+                          significant == 'TRUE'))
+        return {'tests': tests}
+
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+# Started by the first do_stats call with the Rworker engine
+r_worker = None
+
+
+def stop_r_worker():
+    """Stop the R worker if this run started one"""
+    global r_worker
+    if r_worker is not None:
+        r_worker.close()
+        r_worker = None
+
+
+def do_stats(parsed_data, file_name_var, config_dict, reproduction_data, pipeline=None):
+    """Perform stats with the configured engine and return the results of the Python and Rworker engines
+
+    With a pipeline, each metric is a node that only reruns when its data or the stats options changed.
+    """
+    global r_worker
+    # just a note: file_name_var tells R if the data is clonality or %Tcell
+    correction = config_dict['config_correction']
+    verbose = config_dict['config_output_verbose']
+    engine = config_dict['config_engine']
+
+    results = {}
+    for data_type, values, repro in stats_inputs(parsed_data, file_name_var, reproduction_data):
+        post_stats = 'post_stats_' + data_type + '.tsv'
+        if pipeline is not None:
+            node = 'stats:' + data_type
+            key = pipeline.key(values, repro, correction, verbose, engine)
+            if not pipeline.should_run(node, key, outputs=[post_stats]):
+                continue
+            # Both engines append to the post_stats file, so start it over
+            if os.path.exists(post_stats):
+                os.remove(post_stats)
+
+        if engine == 'python':
+            results[data_type] = python_stats(values, correction, verbose)
+            write_post_stats(data_type, results[data_type], repro)
+
+        # Stream the tables to the running R process
+        elif engine == 'rworker':
+            stats_rows, repro_rows = pre_stats_rows(data_type, values, repro, correction, verbose)
+            if r_worker is None:
+                r_worker = RWorker()
+            results[data_type] = r_worker.run(data_type, stats_rows, repro_rows)
+
+        else:
+            stats_rows, repro_rows = pre_stats_rows(data_type, values, repro, correction, verbose)
+            # Write dict to tsv
+            with open("pre_stats.tsv", 'w', newline='') as outfile:
+                csv.writer(outfile, delimiter='\t').writerows(stats_rows)
+
+            with open("pre_repro.tsv", 'w', newline='') as outfile2:
+                csv.writer(outfile2, delimiter='\t').writerows(repro_rows)
 
             # Run R script
             cmd = 'Rscript'
             script = 'clonality.R'
-            subprocess.call([cmd, script])
+            if subprocess.call([cmd, script]) != 0:
+                results[data_type] = None
+
+        # A metric R failed on runs again next time
+        if pipeline is not None and results.get(data_type, True) is not None:
+            pipeline.done(node, key)
+
+    return results
+
+
+def rank_values(values):
+    """Return average ranks of values (ties share their mean rank) and the size of each tie"""
+    order = np.argsort(values, kind='mergesort')
+    ordered = values[order]
+    # Start of each run of equal values in sorted order
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    ties = np.diff(np.r_[starts, len(values)])
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat(starts + (ties + 1) / 2, ties)
+    return ranks, ties
+
+
+def normal_upper_tail(z):
+    """Return P(Z > z) for a standard normal Z"""
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def wilcox_counts(m, n):
+    """Return the number of orderings giving each Mann-Whitney W from 0 to m * n"""
+    # counts[j, s] is the number of ways to pick j of the ranks seen so far with rank sum s
+    counts = np.zeros((m + 1, m * (2 * n + m + 1) // 2 + 1))
+    counts[0, 0] = 1
+    for rank in range(1, m + n + 1):
+        counts[1:, rank:] = counts[1:, rank:] + counts[:-1, :-rank]
+    return counts[m, m * (m + 1) // 2:]
+
+
+def mann_whitney(x, y):
+    """Return the two sided p-value of R's wilcox.test(x, y)"""
+    m, n = len(x), len(y)
+    ranks, ties = rank_values(np.concatenate((x, y)))
+    statistic = ranks[:m].sum() - m * (m + 1) / 2
+
+    # Exact distribution for small samples without ties, like R
+    if m < 50 and n < 50 and (ties == 1).all():
+        counts = wilcox_counts(m, n)
+        w = int(round(statistic))
+        if statistic > m * n / 2:
+            p = counts[w:].sum() / counts.sum()
+        else:
+            p = counts[:w + 1].sum() / counts.sum()
+        return min(2 * p, 1)
+
+    # Normal approximation with continuity correction
+    z = statistic - m * n / 2
+    sigma = math.sqrt((m * n / 12) * ((m + n + 1) - (ties ** 3 - ties).sum() / ((m + n) * (m + n - 1))))
+    if sigma == 0:
+        return float('nan')
+    z = (z - np.sign(z) * 0.5) / sigma
+    return 2 * min(normal_upper_tail(z), normal_upper_tail(-z))
+
+
+def adjust_pvalues(pvalues, correction):
+    """Return pvalues adjusted with the Bonferroni, BH or no correction"""
+    m = len(pvalues)
+    if 'bonferroni' in correction.lower():
+        return np.minimum(1, pvalues * m)
+    elif 'bh' in correction.lower():
+        # Step up from the largest p-value, keeping the adjusted values monotone
+        order = np.argsort(pvalues)[::-1]
+        adjusted = np.empty(m)
+        adjusted[order] = np.minimum(1, np.minimum.accumulate(pvalues[order] * m / np.arange(m, 0, -1)))
+        return adjusted
+    return pvalues
+
+
+def dunn_test(samples, correction):
+    """Return comparison labels and adjusted p-values of Dunn's test, ordered like R's dunn.test"""
+    sizes = np.array([len(sample) for sample in samples])
+    ranks, ties = rank_values(np.concatenate(samples))
+    total = sizes.sum()
+    mean_ranks = np.add.reduceat(ranks, np.r_[0, np.cumsum(sizes)[:-1]]) / sizes
+
+    # Every pair (i, j) with j < i, in the order dunn.test lists its comparisons
+    i, j = np.tril_indices(len(samples), -1)
+    tie_term = (ties ** 3 - ties).sum() / (12 * (total - 1))
+    sigma = np.sqrt((total * (total + 1) / 12 - tie_term) * (1 / sizes[j] + 1 / sizes[i]))
+    z = (mean_ranks[j] - mean_ranks[i]) / sigma
+
+    # dunn.test reports P(Z > |z|), which is compared to alpha rather than alpha / 2 downstream
+    pvalues = np.array([normal_upper_tail(abs(value)) for value in z])
+    return i, j, adjust_pvalues(pvalues, correction)
+
+
+def python_stats(values, correction, verbose):
+    """Return the summary statistics and test results that clonality.R computes"""
+    # Groups in order of appearance (for the U-test label) and sorted (like R's factor levels)
+    appearance = []
+    grouped = {}
+    for group, value in values:
+        if value is None:
+            continue
+        if group not in grouped:
+            appearance.append(group)
+            grouped[group] = []
+        grouped[group].append(float(value))
+    groups = sorted(grouped)
+    samples = [np.array(grouped[group]) for group in groups]
+
+    # Summary statistics (R's quantile type 7 is numpy's default), standard deviation and SEM
+    summary = {name: [] for name in ('min', '1stquartile', 'median', 'mean', '3rdquartile', 'max')}
+    sd = []
+    sem = []
+    for sample in samples:
+        quartiles = np.percentile(sample, [0, 25, 50, 75, 100])
+        for name, stat in zip(('min', '1stquartile', 'median', '3rdquartile', 'max'), quartiles):
+            summary[name].append(stat)
+        summary['mean'].append(sample.mean())
+        sd.append(sample.std(ddof=1) if len(sample) > 1 else float('nan'))
+        sem.append(sd[-1] / math.sqrt(len(sample)))
+
+    # U-test for two groups, Dunn's test for more
+    tests = []
+    if len(groups) == 2:
+        p = mann_whitney(samples[0], samples[1])
+        tests.append(('utest', 'N/A', appearance[0] + ' - ' + appearance[1], p))
+    elif len(groups) > 2:
+        corrections = ['none', 'bh', 'bonferroni'] if verbose else [correction]
+        for method in corrections:
+            i, j, pvalues = dunn_test(samples, method)
+            for a, b, p in zip(i, j, pvalues):
+                tests.append(('dunntest', method, groups[b] + ' - ' + groups[a], p))
+
+    return {'groups': groups, 'summary': summary, 'sd': sd, 'sem': sem,
+            'tests': [(test, method, comparison, p, p < 0.05) for test, method, comparison, p in tests]}
+
+
+def format_r(value, digits=15):
+    """Return value the way R's write.table prints it"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NA'
+    elif isinstance(value, (bool, np.bool_)):
+        return 'TRUE' if value else 'FALSE'
+    elif isinstance(value, str):
+        return '"' + value + '"'
+    return '%.*g' % (digits, value)
+
+
+def write_post_stats(data_type, stats, repro):
+    """Append stats to post_stats_<data_type>.tsv in the layout clonality.R writes"""
+    def row(name, cells):
+        # Transposed tables are character matrices in R, so every cell is quoted
+        return '\t'.join(['"' + name + '"'] + ['"' + c + '"' if c != 'NA' else c for c in cells]) + '\n'
+
+    def numbers(values):
+        return [format_r(value, 7) for value in values]
+
+    lines = [row('#SUMMARYgroup', stats['groups'])]
+    for name in ('min', '1stquartile', 'median', 'mean', '3rdquartile', 'max'):
+        lines.append(row('#SUMMARY' + name, numbers(stats['summary'][name])))
+    lines.append(row('#SDgroup', stats['groups']))
+    lines.append(row('#SDvalue', numbers(stats['sd'])))
+    lines.append(row('#SEMgroup', stats['groups']))
+    lines.append(row('#SEMvalue', numbers(stats['sem'])))
+
+    lines.append('\t'.join(format_r(header) for header in
+                           ("#test", "#multiplecorrection", "#comparisongroups", "#pvalue", "#significant")) + '\n')
+    for test in stats['tests']:
+        significant = None if math.isnan(test[3]) else test[4]
+        lines.append('\t'.join(format_r(cell) for cell in test[:4] + (significant,)) + '\n')
+    for sample, group, value in repro:
+        lines.append('\t'.join(format_r(cell) for cell in ('#data:', sample, group, value)) + '\n')
+
+    with open('post_stats_' + data_type + '.tsv', 'a') as outfile:
+        outfile.writelines(lines)
 
 
 def plot_graph(parsed_data,
                file_name_var,
                y_label,
                config_dict,
-               graph_name="plot.png"):
+               graph_name="plot.png",
+               show=True):
     """Create data plots"""
+    # Jitter is random, seed it so a figure renders the same every time and in any process
+    np.random.seed(0)
+
     # Set the config options
     config_correction = config_dict['config_correction']
 
@@ -1313,7 +1761,8 @@ def plot_graph(parsed_data,
             fig = plt.gcf()
             fig.set_size_inches(config_width, config_height)
             fig.savefig(graph_name, bbox_inches="tight", dpi=config_dpi)
-            plt.show()
+            if show:
+                plt.show()
             plt.close()
         except PermissionError:
             if '\\' in graph_name:
@@ -1337,7 +1786,8 @@ def plot_graph(parsed_data,
             fig = plt.gcf()
             fig.set_size_inches(config_width, config_height)
             plt.savefig(graph_name, bbox_inches="tight", dpi=config_dpi)
-            plt.show()
+            if show:
+                plt.show()
             plt.close()
         except PermissionError:
             if '\\' in graph_name:
@@ -1348,8 +1798,73 @@ def plot_graph(parsed_data,
                 pass
 
 
-def delete_old_files(pre=False, post=False, errorlog=False):
-    """Remove old files before running"""
+def use_agg():
+    """Switch a plotting worker to the non-interactive Agg backend"""
+    plt.switch_backend('Agg')
+
+
+def render_plot(plot_args):
+    """Render one figure and return whether it rendered, logging a ValueError so the other figures still render"""
+    try:
+        plot_graph(**plot_args)
+        return True
+    except ValueError as error:
+        error_log('Could not plot ' + plot_args['graph_name'] + ': ' + str(error))
+        return False
+
+
+def plot_fingerprint(plot_args):
+    """Return a hash of the data, stats, config options and labels a figure is drawn from"""
+    config_dict = plot_args['config_dict']
+    inputs = [list(plot_args['parsed_data'].items()),
+              plot_args['file_name_var'],
+              plot_args['y_label'],
+              plot_args['graph_name'],
+              {option: config_dict[option] for option in PLOT_OPTIONS}]
+    digest = hashlib.sha256(json.dumps(inputs).encode())
+    # The annotations, mean and error bars come from the post_stats file
+    try:
+        with open('post_stats_' + plot_args['file_name_var'] + '.tsv', 'rb') as stats:
+            digest.update(stats.read())
+    except FileNotFoundError:
+        pass
+    return digest.hexdigest()
+
+
+def render_plots(plots, workers=1, pipeline=None):
+    """Render each plot_graph call in plots, in that many worker processes if workers is more than one
+
+    With a pipeline, each figure is a node that only reruns when its data, stats, config options or
+    labels changed.
+    """
+    # Fingerprint before rendering, since plot_graph filters the data it's given
+    stale = []
+    for plot_args in plots:
+        node = 'plot:' + plot_args['graph_name']
+        key = None
+        if pipeline is not None:
+            key = pipeline.key(plot_fingerprint(plot_args))
+            if not pipeline.should_run(node, key,
+                                       outputs=[plot_args['graph_name']],
+                                       upstream=['stats:' + plot_args['file_name_var']]):
+                continue
+        stale.append((plot_args, node, key))
+
+    if workers <= 1:
+        rendered = [render_plot(plot_args) for plot_args, node, key in stale]
+    else:
+        # Workers render with Agg and without plt.show(), so nothing waits on a window
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=use_agg) as executor:
+            rendered = list(executor.map(render_plot, [dict(plot_args, show=False) for plot_args, node, key in stale]))
+
+    # A figure that failed renders again next time
+    for (plot_args, node, key), success in zip(stale, rendered):
+        if pipeline is not None and success:
+            pipeline.done(node, key)
+
+
+def delete_old_files(pre=False, post=False, errorlog=False, keep=()):
+    """Remove old files before running, other than the ones in keep"""
     if pre:
         # Remove pre_stat files
         try:
@@ -1365,7 +1880,8 @@ def delete_old_files(pre=False, post=False, errorlog=False):
         try:
             post_files = glob.glob("post_*.tsv")
             for f in post_files:
-                os.remove(f)
+                if f not in keep:
+                    os.remove(f)
         except FileNotFoundError:
             # The file doesn't exist so don't worry about deleting it
             pass
@@ -1382,7 +1898,8 @@ def delete_old_files(pre=False, post=False, errorlog=False):
 def create_master_file(config_masterfile):
     """Concatenate output files into one file if the option is true"""
     if config_masterfile is True:
-        read_files = glob.glob("post_stats_*.tsv")
+        # Don't read the master file from the last run back into itself
+        read_files = sorted(f for f in glob.glob("post_stats_*.tsv") if f != "post_stats_complete.tsv")
         with open("post_stats_complete.tsv", "w") as outfile:
             for f in read_files:
                 with open(f, "r") as infile:
@@ -1390,33 +1907,115 @@ def create_master_file(config_masterfile):
                     outfile.write(metric_name.upper() + "\n" + infile.read() + "\n")
 
 
+class Pipeline:
+    """The nodes of a run, memoized on the hashes of their inputs
+
+    A run goes discover -> parse -> clean -> stats -> plot -> masterfile. Discovering the
+    files, parsing them (through the sample cache) and cleaning the data always run. Each
+    metric's stats, each figure and the master file are nodes whose input hashes are kept in
+    the state file, and a node only runs when its hash changed, one of its outputs is
+    missing, a node upstream of it ran, or with --force. With dry_run no node runs and
+    report() lists the ones that would.
+    """
+    def __init__(self, state_path=PIPELINE_STATE, force=False, dry_run=False):
+        self.state_path = state_path
+        self.force = force
+        self.dry_run = dry_run
+        try:
+            with open(state_path, 'r') as state_file:
+                self.previous = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            self.previous = {}
+        # Nodes reached this run that are up to date, and every node reached with whether it runs
+        self.state = {}
+        self.plan = []
+
+        # Changing the code changes every result
+        self.code = hashlib.sha256()
+        for script in (os.path.abspath(__file__), 'clonality.R'):
+            try:
+                with open(script, 'rb') as script_file:
+                    self.code.update(script_file.read())
+            except FileNotFoundError:
+                pass
+
+
+    def key(self, *inputs):
+        """Return a hash of a node's inputs and the code"""
+        digest = self.code.copy()
+        digest.update(json.dumps(inputs, default=str).encode())
+        return digest.hexdigest()
+
+
+    def should_run(self, node, key, outputs=(), upstream=()):
+        """Return whether the node has to run, which is never on a dry run"""
+        run = (self.force
+               or self.previous.get(node) != key
+               or not all(os.path.exists(output) for output in outputs)
+               or any(self.ran(name) for name in upstream))
+        self.plan.append((node, run))
+        if not run:
+            self.state[node] = key
+        return run and not self.dry_run
+
+
+    def ran(self, node):
+        """Return whether the node ran (or would run) this run"""
+        return (node, True) in self.plan
+
+
+    def done(self, node, key):
+        self.state[node] = key
+
+
+    def save(self):
+        """Save the nodes that are up to date, which drops the ones this run didn't reach"""
+        if not self.dry_run:
+            with open(self.state_path, 'w') as state_file:
+                json.dump(self.state, state_file, indent=2, sort_keys=True)
+
+
+    def report(self):
+        """Print each node and whether it runs"""
+        for node, run in self.plan:
+            print(('run   ' if run else 'skip  ') + node)
+
+
 def error_log(errornote):
     """Write errors and exceptions to a log file"""
     errortime = time.strftime('%Y%m%d %H:%M:%S')
     errorstring = str(errortime + ' -- ' + errornote + "\n")
-    with open("error.log", "a") as error_log:
+    if ERROR_LOG is None:
+        sys.stderr.write(errorstring)
+        return
+    with open(ERROR_LOG, "a") as error_log:
         error_log.write(errorstring)
 
 
 if __name__ == "__main__":
 
     """Perform clonality analysis"""
-    # Remove old error log files
-    delete_old_files(errorlog=True)
+    # Nodes whose inputs haven't changed since the last run are skipped, all of them run with --force
+    pipeline = Pipeline(force='--force' in sys.argv, dry_run='--dry-run' in sys.argv)
+
+    # A dry run doesn't touch any files, its messages go to stderr
+    if pipeline.dry_run:
+        ERROR_LOG = None
+    else:
+        # Remove old error log files
+        delete_old_files(errorlog=True)
 
-    # Prep sample list, metadata, and config from command line
+    # Discover: prep sample list, metadata, and config from command line
     samples_list, metadata_dict, cfg_file, arblist = prep_files(metadatafilename='metadata.tsv',
-                                                                configfilename='config.cfg')
+                                                                configfilename='config.cfg',
+                                                                dry_run=pipeline.dry_run)
 
     # check and return a configuration dictionary
     config_dict = config_checker(cfg_file)
 
-    # Remove old output files
-    if config_dict['config_overwrite']:
-        delete_old_files(post=True)
-
-    # parse the data
-    parsed_clonality, parsed_tcell, reproduction_clonality, reproduction_tcell = get_data(samples_list, metadata_dict)
+    # Parse the data
+    parsed_clonality, parsed_tcell, reproduction_clonality, reproduction_tcell = get_data(samples_list, metadata_dict,
+                                                                                          read_only=pipeline.dry_run)
 
     # Parse the arbitrary data if arblist has anything in it
     if len(arblist) > 0:
@@ -1425,7 +2024,8 @@ if __name__ == "__main__":
     else:
         arb_dicts = []
 
-    # Do stats and plotting if there are data in the dictionaries
+    # Clean and do stats if there are data in the dictionaries, collecting the plots
+    plots = []
     # Clonality:
     if len(parsed_clonality) > 0:
         file_name_var = 'clonality'
@@ -1433,13 +2033,13 @@ if __name__ == "__main__":
         clonality_data = clean_data(parsed_clonality, file_name_var)
         # Do statistics
         if config_dict['config_overwrite']:
-            do_stats(clonality_data, file_name_var, config_dict, reproduction_clonality)
-        # Plot the data
-        plot_graph(clonality_data,
-                   file_name_var,
-                   config_dict=config_dict,
-                   y_label="CLONALITY",
-                   graph_name="CLONALITY.png")
+            do_stats(clonality_data, file_name_var, config_dict, reproduction_clonality, pipeline)
+        # Plot the data once all the stats are done
+        plots.append(dict(parsed_data=clonality_data,
+                          file_name_var=file_name_var,
+                          config_dict=config_dict,
+                          y_label="CLONALITY",
+                          graph_name="CLONALITY.png"))
 
     # %T Cell
     try:
@@ -1449,13 +2049,13 @@ if __name__ == "__main__":
             tcell_data = clean_data(parsed_tcell, file_name_var)
             # Do statistics
             if config_dict['config_overwrite']:
-                do_stats(tcell_data, file_name_var, config_dict, reproduction_tcell)
-            # Plot the data
-            plot_graph(tcell_data,
-                       file_name_var,
-                       config_dict=config_dict,
-                       y_label="% T CELL RECEPTOR",
-                       graph_name="TCELL_GRAPH.png")
+                do_stats(tcell_data, file_name_var, config_dict, reproduction_tcell, pipeline)
+            # Plot the data once all the stats are done
+            plots.append(dict(parsed_data=tcell_data,
+                              file_name_var=file_name_var,
+                              config_dict=config_dict,
+                              y_label="% T CELL RECEPTOR",
+                              graph_name="TCELL_GRAPH.png"))
     except ValueError:
         pass
 
@@ -1466,18 +2066,48 @@ if __name__ == "__main__":
         arb_data = clean_data(arb_dicts, file_name_var)
         # Do statistics
         if config_dict['config_overwrite']:
-            do_stats(arb_data, file_name_var, config_dict, reproduction_data=arb_data)
-        # Plot the data
+            do_stats(arb_data, file_name_var, config_dict, reproduction_data=arb_data, pipeline=pipeline)
+        # Plot the data once all the stats are done
         for i, arb in enumerate(arblist):
             if len(arb) > 0:
                 file_name_var = 'arb' + str(i + 1)
-                plot_graph(arb_data[i],
-                           file_name_var,
-                           config_dict=config_dict,
-                           y_label=arb_names[i].upper(),
-                           graph_name=arb_names[i].upper() + '.png')
+                plots.append(dict(parsed_data=arb_data[i],
+                                  file_name_var=file_name_var,
+                                  config_dict=config_dict,
+                                  y_label=arb_names[i].upper(),
+                                  graph_name=arb_names[i].upper() + '.png'))
+
+    # All of the stats are done
+    stop_r_worker()
+
+    # Stats that are still current were kept, so only remove the output files of metrics that are gone
+    stats_nodes = [node for node, run in pipeline.plan if node.startswith('stats:')]
+    if config_dict['config_overwrite'] and not pipeline.dry_run:
+        keep = ['post_stats_' + node.split(':', 1)[1] + '.tsv' for node in stats_nodes]
+        if config_dict['config_masterfile']:
+            keep.append('post_stats_complete.tsv')
+        delete_old_files(post=True, keep=keep)
+
+    # Render the figures that changed, in parallel if Plot workers is more than one
+    render_plots(plots, config_dict['config_plot_workers'], pipeline)
 
     # Combine stats files or separate them?
-    create_master_file(config_dict['config_masterfile'])
+    if config_dict['config_masterfile']:
+        post_files = sorted(f for f in glob.glob("post_stats_*.tsv") if f != "post_stats_complete.tsv")
+        post_hashes = []
+        for post_file in post_files:
+            with open(post_file, 'rb') as post:
+                post_hashes.append(hashlib.sha256(post.read()).hexdigest())
+        masterfile_key = pipeline.key(post_files, post_hashes)
+        if pipeline.should_run('masterfile', masterfile_key,
+                               outputs=['post_stats_complete.tsv'], upstream=stats_nodes):
+            create_master_file(config_dict['config_masterfile'])
+            pipeline.done('masterfile', masterfile_key)
+
     # Remove unnecessary files (pre_stats)
-    delete_old_files(pre=True)
+    if not pipeline.dry_run:
+        delete_old_files(pre=True)
+
+    pipeline.save()
+    if pipeline.dry_run:
+        pipeline.report()